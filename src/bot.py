@@ -8,18 +8,34 @@
 
 import os
 import io
+import re
+import sys
+import argparse
 import csv
+import hashlib
+import gzip
+import shutil
 import json
 import time
+import queue
+import asyncio
 import uuid
+import zlib
+import zipfile
+import xml.etree.ElementTree as ET
 import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple, Set
+from typing import Dict, Any, List, Optional, Tuple, Set, Iterator, Callable
 from datetime import datetime, UTC, timedelta
 
 from dotenv import load_dotenv
 from loguru import logger
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 from html import escape as html_escape
 
 from telegram import (
@@ -86,28 +102,419 @@ def load_env(project_root: Path) -> None:
 # JSONL ПЕРСИСТ
 # ============================================
 
-TICKETS_FILE = DATA_DIR / "tickets.jsonl"
 FEEDBACK_FILE = DATA_DIR / "feedback.jsonl"
+EVENTS_DIR = DATA_DIR / "events"
+TICKETS_LOG = EVENTS_DIR / "tickets.jsonl"     # база имён сегментов + tickets.index.json
 
-def _append_jsonl(path: Path, record: Dict[str, Any]) -> None:
-    record = {**record, "ts": record.get("ts") or datetime.now(UTC).isoformat(timespec="seconds")}
-    with path.open("a", encoding="utf-8") as f:
-        json.dump(record, f, ensure_ascii=False)
-        f.write("\n")
+JSONL_FLUSH_MODES = ("record", "interval", "shutdown")
 
-def save_ticket_event_jsonl(event: Dict[str, Any]) -> None:
-    _append_jsonl(TICKETS_FILE, event)
+class JsonlSink:
+    """Дозапись JSONL через постоянно открытый файл.
+
+    Строки копятся в буфере и уходят одним write(): сразу (record),
+    не реже чем раз в interval_ms (interval — фоновый поток) или только
+    при close() (shutdown). fsync=True — os.fsync после каждого сброса.
+    До configure()/start() работает в режиме record.
+    """
+
+    def __init__(self, path: Path, mode: str = "record", interval_ms: int = 200, fsync: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._buf: List[str] = []
+        self._f: Optional[io.TextIOWrapper] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.configure(mode, interval_ms, fsync)
+
+    def configure(self, mode: str, interval_ms: int = 200, fsync: bool = False) -> None:
+        if mode not in JSONL_FLUSH_MODES:
+            raise ValueError(f"unknown JSONL flush mode: {mode}")
+        self.mode = mode
+        self.interval_ms = max(1, interval_ms)
+        self.fsync = fsync
+
+    def start(self) -> None:
+        if self.mode != "interval" or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"jsonl-{self.path.name}", daemon=True)
+        self._thread.start()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self.write_many([record])
+
+    def write_many(self, records: List[Dict[str, Any]]) -> None:
+        if not records:
+            return
+        now = datetime.now(UTC).isoformat(timespec="seconds")
+        records = [{**r, "ts": r.get("ts") or now} for r in records]
+        lines = [json.dumps(r, ensure_ascii=False) + "\n" for r in records]
+        with self._lock:
+            self._append_locked(lines, [r["ts"] for r in records])
+            if self.mode == "record":
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def _append_locked(self, lines: List[str], ts: List[str]) -> None:
+        self._buf.extend(lines)
+
+    def _open_locked(self) -> io.TextIOWrapper:
+        return self.path.open("a", encoding="utf-8")
+
+    def _flush_locked(self) -> None:
+        if not self._buf:
+            return
+        if self._f is None:
+            self._f = self._open_locked()
+        self._f.write("".join(self._buf))
+        self._buf.clear()
+        self._f.flush()
+        if self.fsync:
+            os.fsync(self._f.fileno())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_ms / 1000):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(f"[JSONL] flush {self.path.name} failed")
+
+    def _close_file_locked(self) -> None:
+        if self._f is not None:
+            if not self.fsync:
+                os.fsync(self._f.fileno())  # при остановке/ротации сбрасываем на диск всегда
+            self._f.close()
+            self._f = None
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        with self._lock:
+            self._flush_locked()
+            self._close_file_locked()
+
+def _segment_open(path: Path):
+    return gzip.open(path, "rt", encoding="utf-8") if path.suffix == ".gz" else path.open("r", encoding="utf-8")
+
+class SegmentedJsonlSink(JsonlSink):
+    """JsonlSink, который режет лог на сегменты по времени.
+
+    Сегмент — <stem>-YYYYmmddTHHMMSSZ.jsonl на окно segment_s секунд;
+    при переходе в новое окно прошлый сегмент сжимается в .jsonl.gz.
+    Рядом лежит <stem>.index.json: файл, first_ts/last_ts, число строк
+    по каждому сегменту — по нему iter_jsonl_range() открывает только
+    сегменты, пересекающиеся с запрошенным интервалом.
+    """
+
+    def __init__(self, path: Path, segment_s: int = 24 * 3600, **kwargs: Any):
+        self.segment_s = segment_s
+        self.index_path = path.with_name(f"{path.stem}.index.json")
+        self._segments: List[Dict[str, Any]] = load_segment_index(self.index_path)
+        self._window: Optional[int] = None
+        super().__init__(path, **kwargs)
+
+    def _segment_name(self, window: int) -> str:
+        return f"{self.path.stem}-{datetime.fromtimestamp(window, UTC):%Y%m%dT%H%M%SZ}.jsonl"
+
+    def _append_locked(self, lines: List[str], ts: List[str]) -> None:
+        window = int(time.time()) // self.segment_s * self.segment_s
+        if window != self._window:
+            self._flush_locked()
+            self._roll_locked(window)
+        seg = self._segments[-1]
+        seg["first_ts"] = seg["first_ts"] or min(ts)
+        seg["last_ts"] = max(seg["last_ts"] or "", *ts)
+        seg["lines"] += len(lines)
+        self._buf.extend(lines)
+
+    def _open_locked(self) -> io.TextIOWrapper:
+        return (self.path.parent / self._segments[-1]["file"]).open("a", encoding="utf-8")
+
+    def _roll_locked(self, window: int) -> None:
+        self._close_file_locked()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        name = self._segment_name(window)
+        # Все незакрытые сегменты, кроме текущего окна (в т.ч. оставшиеся после падения), — в gzip
+        for seg in self._segments:
+            if not seg["file"].endswith(".gz") and seg["file"] != name:
+                self._compress_segment(seg)
+        if not self._segments or self._segments[-1]["file"] != name:
+            self._segments.append({"file": name, "first_ts": None, "last_ts": None, "lines": 0})
+        self._window = window
+        self._save_index()
+
+    def _compress_segment(self, seg: Dict[str, Any]) -> None:
+        src = self.path.parent / seg["file"]
+        dst = src.with_name(src.name + ".gz")
+        if src.exists():
+            with src.open("rb") as f_in, gzip.open(dst, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        seg["file"] = dst.name
+        self._save_index()
+        src.unlink(missing_ok=True)
+        logger.info(f"[JSONL] segment compressed: {dst.name}")
+
+    def _save_index(self) -> None:
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"segments": self._segments}, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.index_path)
+
+    def close(self) -> None:
+        super().close()
+        with self._lock:
+            if self._segments:
+                self._save_index()
+
+def load_segment_index(index_path: Path) -> List[Dict[str, Any]]:
+    if not index_path.exists():
+        return []
+    return json.loads(index_path.read_text(encoding="utf-8")).get("segments", [])
+
+def iter_jsonl_range(path: Path, since: Optional[str] = None, until: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Записи сегментированного лога с since <= ts <= until, по порядку,
+    потоково. Сегменты вне интервала (по индексу) не открываются; у
+    несжатого (текущего) сегмента last_ts может отставать — его читаем всегда."""
+    for seg in load_segment_index(path.with_name(f"{path.stem}.index.json")):
+        compressed = seg["file"].endswith(".gz")
+        if until and seg["first_ts"] and seg["first_ts"] > until:
+            continue
+        if since and compressed and seg["last_ts"] and seg["last_ts"] < since:
+            continue
+        seg_path = path.parent / seg["file"]
+        if not seg_path.exists() and not compressed:
+            seg_path = seg_path.with_name(seg_path.name + ".gz")  # сжат после чтения индекса
+        with _segment_open(seg_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                rec = json.loads(line)
+                ts = rec.get("ts") or ""
+                if (since and ts < since) or (until and ts > until):
+                    continue
+                yield rec
+
+TICKETS_SINK = SegmentedJsonlSink(TICKETS_LOG)
+FEEDBACK_SINK = JsonlSink(FEEDBACK_FILE)
+
+def configure_jsonl_sinks() -> None:
+    """JSONL_FLUSH_MODE=record|interval|shutdown, JSONL_FLUSH_MS, JSONL_FSYNC=1,
+    JSONL_SEGMENT_HOURS (из .env)."""
+    mode = os.getenv("JSONL_FLUSH_MODE", "interval").strip().lower()
+    try:
+        interval_ms = int(os.getenv("JSONL_FLUSH_MS", "200"))
+    except ValueError:
+        interval_ms = 200
+    fsync = os.getenv("JSONL_FSYNC", "0").strip() == "1"
+    try:
+        TICKETS_SINK.segment_s = max(1, int(float(os.getenv("JSONL_SEGMENT_HOURS", "24")) * 3600))
+    except ValueError:
+        pass
+    for sink in (TICKETS_SINK, FEEDBACK_SINK):
+        sink.configure(mode, interval_ms, fsync)
+        sink.start()
+    logger.info(f"[JSONL] flush mode={mode} interval={interval_ms}ms fsync={fsync} "
+                f"segment={TICKETS_SINK.segment_s}s")
+
+def close_jsonl_sinks() -> None:
+    for sink in (TICKETS_SINK, FEEDBACK_SINK):
+        sink.close()
 
 def save_feedback_jsonl(event: Dict[str, Any]) -> None:
-    _append_jsonl(FEEDBACK_FILE, event)
+    FEEDBACK_SINK.write(event)
+
+# ============================================
+# МОДЕЛЬ ЗАЯВКИ
+# ============================================
+
+# Статус хранится кодом (индекс в кортеже); 0 — статус не задан (старые записи).
+TICKET_STATUSES = ("", "created", "queued", "accepted", "rejected", "closed", "clarifying")
+_STATUS_CODE = {s: i for i, s in enumerate(TICKET_STATUSES)}
+
+def _intern(s: Optional[str]) -> Optional[str]:
+    # Группы/категории — десяток значений на тысячи заявок: держим по одному экземпляру строки
+    return sys.intern(s) if s else s
+
+def _int_or_none(v: Any) -> Optional[int]:
+    try:
+        return int(v) if v not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+@dataclass(slots=True)
+class Ticket:
+    """Заявка в памяти. Без __dict__ и вложенного classification:
+    группа/категория — интернированные строки, статус — int-код."""
+
+    id: str
+    submitter_id: Optional[int] = None
+    submitter_name: Optional[str] = None
+    submitter_chat_id: Optional[int] = None
+    text: str = ""
+    group: str = "Неопределено"
+    category: str = "Другое"
+    status_code: int = 1
+    initial_group: Optional[str] = None
+    created_ts: Optional[str] = None
+    queued_ts: Optional[str] = None
+    accepted_ts: Optional[str] = None
+    rejected_ts: Optional[str] = None
+    closed_ts: Optional[str] = None
+    executor_id: Optional[int] = None
+    executor_name: Optional[str] = None
+    reject_reason_code: Optional[str] = None
+    reject_comment: Optional[str] = None
+    leader_id: Optional[int] = None
+    leader_name: Optional[str] = None
+    leader_decision_ts: Optional[str] = None
+    rerouted_to_group: Optional[str] = None
+    rerouted_ts: Optional[str] = None
+    clarify_question: Optional[str] = None
+    clarify_requested_ts: Optional[str] = None
+    clarify_answer: Optional[str] = None
+    clarify_answered_ts: Optional[str] = None
+    group_chat_id: Optional[int] = None
+    group_message_id: Optional[int] = None
+    pending_reject: Optional[Dict[str, Any]] = None
+    completed_by: Optional[int] = None
+    norm_text: Optional[str] = None     # кэш normalize_text(text), в БД не пишется
+
+    def __post_init__(self):
+        self.group = _intern(self.group)
+        self.category = _intern(self.category)
+        self.initial_group = _intern(self.initial_group)
+
+    @property
+    def status(self) -> Optional[str]:
+        return TICKET_STATUSES[self.status_code] or None
+
+    @status.setter
+    def status(self, value: Optional[str]) -> None:
+        try:
+            self.status_code = _STATUS_CODE[value or ""]
+        except KeyError:
+            raise ValueError(f"unknown ticket status: {value}") from None
+
+    @property
+    def normalized(self) -> str:
+        if self.norm_text is None:
+            self.norm_text = normalize_text(self.text)
+        return self.norm_text
+
+    def set_group(self, group: str) -> None:
+        self.group = _intern(group)
+
+    def event(self, name: str, **extra: Any) -> Dict[str, Any]:
+        """Payload события: идентификаторы + группа/категория + статус + extra
+        (только изменившиеся поля), без копирования всей заявки."""
+        ev = {"event": name, "ticket_id": self.id, "group": self.group, "category": self.category,
+              "status": self.status}
+        ev.update(extra)
+        return ev
+
+    def snapshot_event(self, name: str, **extra: Any) -> Dict[str, Any]:
+        """Payload с полным состоянием заявки — только для new_text: с него
+        начинается история, дальше события несут лишь изменения."""
+        ev = {"event": name, "ticket_id": self.id, "status": self.status}
+        for f in _TICKET_EVENT_FIELDS:
+            v = getattr(self, f)
+            if v is not None:
+                ev[f] = v
+        ev.update(extra)
+        return ev
+
+    def to_row(self) -> Dict[str, Any]:
+        return {
+            "ticket_id": self.id,
+            "author_id": self.submitter_id,
+            "author_name": self.submitter_name,
+            "text": self.text,
+            "group_name": self.group,
+            "initial_group": self.initial_group,
+            "category": self.category,
+            "created_ts": self.created_ts,
+            "queued_ts": self.queued_ts,
+            "accepted_ts": self.accepted_ts,
+            "rejected_ts": self.rejected_ts,
+            "closed_ts": self.closed_ts,
+            "final_status": self.status,
+            "executor_id": self.executor_id,
+            "executor_name": self.executor_name,
+            "reject_reason_code": self.reject_reason_code,
+            "reject_comment": self.reject_comment,
+            "leader_id": self.leader_id,
+            "leader_name": self.leader_name,
+            "leader_decision_ts": self.leader_decision_ts,
+            "rerouted_to_group": self.rerouted_to_group,
+            "rerouted_ts": self.rerouted_ts,
+            "clarify_question": self.clarify_question,
+            "clarify_requested_ts": self.clarify_requested_ts,
+            "clarify_answer": self.clarify_answer,
+            "clarify_answered_ts": self.clarify_answered_ts,
+            "group_chat_id": self.group_chat_id,
+            "group_message_id": self.group_message_id,
+            "updated_ts": iso_now(),
+            "submitter_chat_id": self.submitter_chat_id,
+            # "" а не NULL: снятое ожидание должно перетереть сохранённое (COALESCE в UPSERT)
+            "pending_reject_json": json.dumps(self.pending_reject, ensure_ascii=False) if self.pending_reject else "",
+        }
+
+    @classmethod
+    def from_row(cls, r: sqlite3.Row) -> "Ticket":
+        """Обратное к to_row: заявка из снапшота tickets."""
+        author_id = _int_or_none(r["author_id"])
+        pending = r["pending_reject_json"]
+        t = cls(
+            id=r["ticket_id"],
+            submitter_id=author_id,
+            submitter_name=r["author_name"],
+            # старые записи без submitter_chat_id: заявки приходят из лички, chat_id == user_id
+            submitter_chat_id=_int_or_none(r["submitter_chat_id"]) or author_id,
+            text=r["text"] or "",
+            group=r["group_name"],
+            category=r["category"],
+            initial_group=r["initial_group"],
+            created_ts=r["created_ts"],
+            queued_ts=r["queued_ts"],
+            accepted_ts=r["accepted_ts"],
+            rejected_ts=r["rejected_ts"],
+            closed_ts=r["closed_ts"],
+            executor_id=_int_or_none(r["executor_id"]),
+            executor_name=r["executor_name"],
+            reject_reason_code=r["reject_reason_code"],
+            reject_comment=r["reject_comment"],
+            leader_id=_int_or_none(r["leader_id"]),
+            leader_name=r["leader_name"],
+            leader_decision_ts=r["leader_decision_ts"],
+            rerouted_to_group=r["rerouted_to_group"],
+            rerouted_ts=r["rerouted_ts"],
+            clarify_question=r["clarify_question"],
+            clarify_requested_ts=r["clarify_requested_ts"],
+            clarify_answer=r["clarify_answer"],
+            clarify_answered_ts=r["clarify_answered_ts"],
+            group_chat_id=_int_or_none(r["group_chat_id"]),
+            group_message_id=_int_or_none(r["group_message_id"]),
+            pending_reject=json.loads(pending) if pending else None,
+        )
+        t.status_code = _STATUS_CODE.get(r["final_status"] or "", 0)
+        return t
+
+_TICKET_EVENT_FIELDS = tuple(f.name for f in fields(Ticket) if f.name not in ("id", "status_code", "norm_text"))
 
 # ============================================
 # SQLITE: СХЕМА / МИГРАЦИИ / УТИЛИТЫ
 # ============================================
 
-SQL_SCHEMA = """
-PRAGMA journal_mode=WAL;
+# Схема ведётся версионированными миграциями (см. MIGRATIONS / db_init):
+# PRAGMA user_version = номер последнего применённого шага.
+# Выпущенные шаги не меняем — только добавляем новые в конец.
 
+SQL_SCHEMA_V1 = """
 CREATE TABLE IF NOT EXISTS users (
     telegram_user_id INTEGER PRIMARY KEY,
     phone_e164 TEXT NOT NULL,
@@ -165,12 +572,50 @@ CREATE TABLE IF NOT EXISTS sync_state (
     system TEXT PRIMARY KEY,
     last_export_ts TEXT
 );
+"""
 
+SQL_INDEXES_V1 = """
 CREATE INDEX IF NOT EXISTS idx_events_ticket_ts ON ticket_events(ticket_id, ts_utc);
 CREATE INDEX IF NOT EXISTS idx_tickets_updated ON tickets(updated_ts);
 """
 
-TICKETS_EXPECTED_COLS = [
+SQL_USER_ROLES = """
+CREATE TABLE IF NOT EXISTS user_roles (
+    telegram_user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,                   -- author / executor / leader / dispatcher / admin
+    group_name TEXT NOT NULL DEFAULT '',  -- СВС/СГЭ/ССТ для executor/leader, иначе ''
+    PRIMARY KEY (telegram_user_id, role, group_name)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_roles_role_group ON user_roles(role, group_name, telegram_user_id);
+"""
+
+# отчётные запросы (см. REPORT_QUERIES / db_check_query_plans)
+SQL_REPORT_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_tickets_created_order ON tickets(COALESCE(created_ts, updated_ts));
+CREATE INDEX IF NOT EXISTS idx_tickets_status_group ON tickets(final_status, group_name, created_ts);
+CREATE INDEX IF NOT EXISTS idx_tickets_executor_status ON tickets(executor_id, final_status);
+"""
+
+SQL_PENDING_REPLIES = """
+CREATE TABLE IF NOT EXISTS pending_replies (
+    chat_id INTEGER NOT NULL,          -- (chat_id, message_id) сообщения бота, на которое ждём реплай
+    message_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,                -- reject_comment_wait / clarify_question / leader_cancel_comment / clarify_answer_wait
+    ticket_id TEXT NOT NULL,
+    executor_id INTEGER,
+    payload_json TEXT NOT NULL,
+    created_ts TEXT NOT NULL,
+    expires_ts TEXT NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_pending_ticket ON pending_replies(ticket_id, kind, executor_id);
+CREATE INDEX IF NOT EXISTS idx_pending_expires ON pending_replies(expires_ts);
+"""
+
+# Колонки таблиц на момент V1 (для подтягивания старых баз, созданных до миграций)
+TICKETS_V1_COLS = [
     "ticket_id","author_id","author_name","text","group_name","initial_group","category",
     "created_ts","queued_ts","accepted_ts","rejected_ts","closed_ts",
     "final_status","executor_id","executor_name","reject_reason_code","reject_comment",
@@ -178,20 +623,255 @@ TICKETS_EXPECTED_COLS = [
     "clarify_question","clarify_requested_ts","clarify_answer","clarify_answered_ts",
     "group_chat_id","group_message_id","updated_ts"
 ]
-USERS_EXPECTED_COLS = [
+USERS_V1_COLS = [
     "telegram_user_id","phone_e164","full_name","roles","verified_at","active"
 ]
-EVENTS_EXPECTED_COLS = [
+EVENTS_V1_COLS = [
     "id","ticket_id","event","ts_utc","author_id","executor_id","group_name","category","payload_json"
 ]
-SYNC_EXPECTED_COLS = [
+SYNC_V1_COLS = [
     "system","last_export_ts"
 ]
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Актуальные колонки (после всех миграций)
+TICKETS_EXPECTED_COLS = TICKETS_V1_COLS + ["submitter_chat_id","pending_reject_json"]
+USERS_EXPECTED_COLS = USERS_V1_COLS
+EVENTS_EXPECTED_COLS = EVENTS_V1_COLS
+SYNC_EXPECTED_COLS = SYNC_V1_COLS + ["cursor"]
+
+# Поля, которые переход может сбросить в NULL (перенаправление снимает исполнителя):
+# в UPSERT пишутся как есть, без COALESCE
+TICKETS_CLEARABLE_COLS = ("executor_id", "executor_name")
+
+# ============================================
+# SQLITE: ПУЛ СОЕДИНЕНИЙ
+# ============================================
+
+DB_POOL_SIZE = 4            # сколько свободных соединений на запись держим на поток
+DB_BUSY_TIMEOUT_MS = 5000
+
+class DbConnectionManager:
+    """Долгоживущие соединения SQLite вместо connect/close на каждый вызов.
+
+    - connection(): соединение на запись из маленького пула текущего потока;
+      на выходе из with — commit (или rollback при исключении), соединение
+      возвращается в пул.
+    - read(): отдельное read-only соединение потока для запросов.
+    """
+
+    def __init__(self, path: Path, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened: List[sqlite3.Connection] = []
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        # check_same_thread=False: привязку к потоку обеспечивает threading.local,
+        # а закрыть всё разом нужно из потока, который завершает приложение.
+        if readonly:
+            conn = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA query_only=1")
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        with self._lock:
+            self._opened.append(conn)
+        return conn
+
+    def _pool(self) -> List[sqlite3.Connection]:
+        pool = getattr(self._local, "pool", None)
+        if pool is None:
+            pool = self._local.pool = []
+        return pool
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        pool = self._pool()
+        conn = pool.pop() if pool else self._connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+            else:
+                self._close(conn)
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        conn = getattr(self._local, "ro", None)
+        if conn is None:
+            conn = self._local.ro = self._connect(readonly=True)
+        yield conn
+
+    def _close(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if conn in self._opened:
+                self._opened.remove(conn)
+        conn.close()
+
+    def close_all(self) -> None:
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for conn in opened:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                logger.exception("[DB] close failed")
+        self._local = threading.local()
+
+DB = DbConnectionManager(DB_PATH)
+
+def db():
+    """Соединение на запись из пула: `with db() as conn: ...` (commit на выходе)."""
+    return DB.connection()
+
+def db_read():
+    """Read-only соединение для запросов (схема должна быть создана db_init)."""
+    return DB.read()
+
+# ============================================
+# SQLITE: ФОНОВЫЙ ПОТОК ЗАПИСИ
+# ============================================
+
+DB_BATCH_MAX_EVENTS = 64     # group commit: сбрасываем пачку, набрав столько событий...
+DB_BATCH_WINDOW_MS = 5       # ...или спустя столько миллисекунд после первой команды
+
+class _WriteCmd:
+    __slots__ = ("fn", "args", "events", "fut")
+
+    def __init__(self, fn: Optional[Callable[..., Any]], args: tuple, events: List[tuple]):
+        self.fn = fn
+        self.args = args
+        self.events = events    # строки для ticket_events (см. _event_row)
+        self.fut: Future = Future()
+
+class DbWriter:
+    """Поток-владелец соединения на запись.
+
+    Хендлеры не трогают sqlite3 в event loop: они кладут команду
+    (fn(conn, *args) и/или строки ticket_events) в очередь и ждут Future.
+    Команды копятся в пачку (group commit): до DB_BATCH_MAX_EVENTS событий
+    или DB_BATCH_WINDOW_MS мс. События пачки вставляются одним executemany,
+    вся пачка — одна транзакция, Future выставляются только после commit,
+    поэтому, дождавшись записи, хендлер может отвечать пользователю.
+    Пока поток не запущен (старт, CLI), команды выполняются синхронно через пул.
+    """
+
+    def __init__(self, manager: DbConnectionManager):
+        self._manager = manager
+        self._queue: "queue.Queue[Optional[_WriteCmd]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        # submit/stop под одним локом: команда не должна попасть в очередь после
+        # стоп-маркера (её бы никто не выполнил, а отправитель ждал бы вечно)
+        self._submit_lock = threading.Lock()
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        with self._submit_lock:
+            if not self.running:
+                return
+            self._stopping = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, fn: Optional[Callable[..., Any]], *args: Any,
+               events: Optional[List[Dict[str, Any]]] = None) -> Future:
+        cmd = _WriteCmd(fn, args, [_event_row(ev) for ev in events or ()])
+        with self._submit_lock:
+            queued = self.running and not self._stopping
+            if queued:
+                self._queue.put(cmd)
+        if not queued:
+            with self._manager.connection() as conn:
+                self._execute_batch(conn, [cmd])
+        return cmd.fut
+
+    def _collect(self, first: _WriteCmd) -> Tuple[List[_WriteCmd], bool]:
+        batch = [first]
+        n_events = len(first.events)
+        deadline = time.monotonic() + DB_BATCH_WINDOW_MS / 1000
+        while n_events < DB_BATCH_MAX_EVENTS:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            n_events += len(item.events)
+        return batch, False
+
+    def _execute_batch(self, conn: sqlite3.Connection, batch: List[_WriteCmd]) -> None:
+        batch = [c for c in batch if c.fut.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            with conn:
+                results = self._apply(conn, batch)
+        except Exception:
+            if len(batch) == 1:
+                logger.exception("[DB WRITER] write failed")
+                batch[0].fut.set_exception(sys.exc_info()[1])
+                return
+            # Пачка откатилась целиком — повторяем по одной, чтобы ошибка
+            # досталась только своей команде.
+            logger.warning(f"[DB WRITER] batch of {len(batch)} failed, retrying one by one")
+            for cmd in batch:
+                try:
+                    with conn:
+                        res = self._apply(conn, [cmd])[0]
+                except Exception as e:
+                    logger.exception(f"[DB WRITER] {getattr(cmd.fn, '__name__', cmd.fn)} failed")
+                    cmd.fut.set_exception(e)
+                else:
+                    cmd.fut.set_result(res)
+            return
+        for cmd, res in zip(batch, results):
+            cmd.fut.set_result(res)
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, batch: List[_WriteCmd]) -> List[Any]:
+        rows = [row for cmd in batch for row in cmd.events]
+        if rows:
+            conn.executemany(SQL_INSERT_EVENT, rows)
+        return [cmd.fn(conn, *cmd.args) if cmd.fn else None for cmd in batch]
+
+    def _run(self) -> None:
+        conn = self._manager._connect()
+        try:
+            stop = False
+            while not stop:
+                first = self._queue.get()
+                if first is None:
+                    break
+                batch, stop = self._collect(first)
+                self._execute_batch(conn, batch)
+        finally:
+            self._manager._close(conn)
+
+DB_WRITER = DbWriter(DB)
+
+async def db_write(fn: Optional[Callable[..., Any]], *args: Any,
+                   events: Optional[List[Dict[str, Any]]] = None) -> Any:
+    """Выполнить fn(conn, *args) (+ вставку events) в потоке записи и дождаться
+    commit пачки, не блокируя loop."""
+    return await asyncio.wrap_future(DB_WRITER.submit(fn, *args, events=events))
 
 def _ensure_columns(conn: sqlite3.Connection, table: str, expected_cols: List[str]) -> List[str]:
     cur = conn.execute(f"PRAGMA table_info({table})")
@@ -206,17 +886,139 @@ def _ensure_columns(conn: sqlite3.Connection, table: str, expected_cols: List[st
     existing2 = [row["name"] for row in cur2.fetchall()]
     return existing2
 
+class SchemaRegistry:
+    """Кэш схемы: списки колонок таблиц и заранее собранный UPSERT для tickets.
+
+    Заполняется в db_init (из кода, если схема актуальна; после миграции — refresh),
+    поэтому горячий путь записи не делает PRAGMA table_info.
+    """
+
+    def __init__(self):
+        self.columns: Dict[str, List[str]] = {}
+        self.tickets_cols: List[str] = []
+        self.tickets_upsert_sql = ""
+
+    def set_columns(self, table: str, cols: List[str]) -> None:
+        self.columns[table] = list(cols)
+        if table == "tickets":
+            self._build_tickets_sql()
+
+    def refresh(self, conn: sqlite3.Connection, table: str) -> None:
+        self.set_columns(table, _get_table_columns(conn, table))
+
+    def has(self, table: str, col: str) -> bool:
+        return col in self.columns.get(table, ())
+
+    def _build_tickets_sql(self) -> None:
+        actual = self.columns["tickets"]
+        cols = [c for c in TICKETS_EXPECTED_COLS if c in actual]
+        self.tickets_cols = cols
+        # Важно: COALESCE — NULL не перетирает уже записанные значения (таймстемпы и т.п.)
+        set_expr = ",".join(
+            f"{c}=excluded.{c}" if c in TICKETS_CLEARABLE_COLS
+            else f"{c}=COALESCE(excluded.{c}, tickets.{c})"
+            for c in cols if c != "ticket_id"
+        )
+        self.tickets_upsert_sql = (
+            f"INSERT INTO tickets({','.join(cols)}) VALUES({','.join('?' for _ in cols)}) "
+            f"ON CONFLICT(ticket_id) DO UPDATE SET {set_expr}"
+        )
+        # Для импорта истории: таймстемпы этапов — «первый выигрывает», остальное — последнее значение
+        replay_expr = ",".join(
+            f"{c}=COALESCE(tickets.{c}, excluded.{c})" if c in REPLAY_FIRST_WINS_COLS
+            else f"{c}=COALESCE(excluded.{c}, tickets.{c})"
+            for c in cols if c != "ticket_id"
+        )
+        self.tickets_replay_sql = (
+            f"INSERT INTO tickets({','.join(cols)}) VALUES({','.join('?' for _ in cols)}) "
+            f"ON CONFLICT(ticket_id) DO UPDATE SET {replay_expr}"
+        )
+
+SCHEMA = SchemaRegistry()
+
+def _exec_sql(conn: sqlite3.Connection, sql: str) -> None:
+    # executescript сам коммитит — внутри шага миграции выполняем по одному оператору
+    for stmt in sql.split(";\n"):
+        if stmt.strip():
+            conn.execute(stmt)
+
+def _add_column(conn: sqlite3.Connection, table: str, name: str, decl: str) -> None:
+    if name not in _get_table_columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+def _m1_base_schema(conn: sqlite3.Connection) -> None:
+    _exec_sql(conn, SQL_SCHEMA_V1)
+    # Базы старых сборок могли быть созданы без части колонок
+    _ensure_columns(conn, "users", USERS_V1_COLS)
+    _ensure_columns(conn, "tickets", TICKETS_V1_COLS)
+    _ensure_columns(conn, "ticket_events", EVENTS_V1_COLS)
+    _ensure_columns(conn, "sync_state", SYNC_V1_COLS)
+    _exec_sql(conn, SQL_INDEXES_V1)
+
+def _m2_sync_cursor(conn: sqlite3.Connection) -> None:
+    _add_column(conn, "sync_state", "cursor", "INTEGER")
+
+def _m3_user_roles(conn: sqlite3.Connection) -> None:
+    _exec_sql(conn, SQL_USER_ROLES)
+    _migrate_user_roles(conn)
+
+def _m4_report_indexes(conn: sqlite3.Connection) -> None:
+    _exec_sql(conn, SQL_REPORT_INDEXES)
+
+def _m5_ticket_rehydration(conn: sqlite3.Connection) -> None:
+    # всё, что нужно, чтобы поднять заявку из БД после рестарта (см. TicketRepository)
+    _add_column(conn, "tickets", "submitter_chat_id", "INTEGER")
+    _add_column(conn, "tickets", "pending_reject_json", "TEXT")
+
+def _m6_pending_replies(conn: sqlite3.Connection) -> None:
+    _exec_sql(conn, SQL_PENDING_REPLIES)
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "base schema", _m1_base_schema),
+    (2, "sync_state.cursor", _m2_sync_cursor),
+    (3, "user_roles", _m3_user_roles),
+    (4, "reporting indexes", _m4_report_indexes),
+    (5, "tickets rehydration columns", _m5_ticket_rehydration),
+    (6, "pending_replies", _m6_pending_replies),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def db_migrate(conn: sqlite3.Connection) -> int:
+    """Применить недостающие шаги MIGRATIONS, каждый — в своей транзакции."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return version
+    conn.execute("PRAGMA journal_mode=WAL")
+    for v, title, step in MIGRATIONS:
+        if v <= version:
+            continue
+        logger.info(f"[DB MIGRATION] v{v}: {title}")
+        conn.execute("BEGIN")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version={v}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = v
+    return version
+
 def db_init() -> None:
     with db() as conn:
-        conn.executescript(SQL_SCHEMA)
-        users_cols   = _ensure_columns(conn, "users", USERS_EXPECTED_COLS)
-        tickets_cols = _ensure_columns(conn, "tickets", TICKETS_EXPECTED_COLS)
-        events_cols  = _ensure_columns(conn, "ticket_events", EVENTS_EXPECTED_COLS)
-        sync_cols    = _ensure_columns(conn, "sync_state", SYNC_EXPECTED_COLS)
-        logger.info(f"[DB SCHEMA] users   = {users_cols}")
-        logger.info(f"[DB SCHEMA] tickets = {tickets_cols}")
-        logger.info(f"[DB SCHEMA] events  = {events_cols}")
-        logger.info(f"[DB SCHEMA] sync    = {sync_cols}")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            db_migrate(conn)
+            for table in ("users", "tickets", "ticket_events", "sync_state"):
+                SCHEMA.refresh(conn, table)
+                logger.info(f"[DB SCHEMA] {table} = {SCHEMA.columns[table]}")
+        else:
+            # Схема актуальна — никакой интроспекции, колонки известны из кода
+            SCHEMA.set_columns("users", USERS_EXPECTED_COLS)
+            SCHEMA.set_columns("tickets", TICKETS_EXPECTED_COLS)
+            SCHEMA.set_columns("ticket_events", EVENTS_EXPECTED_COLS)
+            SCHEMA.set_columns("sync_state", SYNC_EXPECTED_COLS)
+        logger.info(f"[DB SCHEMA] version {SCHEMA_VERSION}")
 
 def iso_now() -> str:
     return datetime.now(UTC).isoformat(timespec="seconds")
@@ -225,180 +1027,432 @@ def _get_table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
     cur = conn.execute(f"PRAGMA table_info({table})")
     return [row["name"] for row in cur.fetchall()]
 
-def _dict_select(d: Dict[str, Any], keys: List[str]) -> Dict[str, Any]:
-    return {k: d.get(k) for k in keys}
-
-def _dynamic_insert(conn: sqlite3.Connection, table: str, row: Dict[str, Any], preferred_order: List[str]) -> None:
-    actual_cols = _get_table_columns(conn, table)
-    cols = [c for c in preferred_order if c in actual_cols]
-    vals = [_dict_select(row, cols).get(c) for c in cols]
-    placeholders = ",".join("?" for _ in cols)
-    col_list = ",".join(cols)
-    sql = f"INSERT INTO {table}({col_list}) VALUES({placeholders})"
-    logger.warning(f"[DB DYNAMIC INSERT] {table}: using cols={cols}")
-    conn.execute(sql, tuple(vals))
-
-def _dynamic_update(conn: sqlite3.Connection, table: str, row: Dict[str, Any], where_key: str, preferred_update_cols: List[str]) -> None:
-    actual_cols = _get_table_columns(conn, table)
-    # Важно: обновляем ТОЛЬКО НЕ-NULL значения, чтобы не перетирать уже записанные таймстемпы
-    cols = [c for c in preferred_update_cols if c in actual_cols and c != where_key and (row.get(c) is not None)]
-    if not cols:
-        if (row.get("updated_ts") is not None) and ("updated_ts" in actual_cols):
-            conn.execute(f"UPDATE {table} SET updated_ts=? WHERE {where_key}=?", (row["updated_ts"], row[where_key]))
-        return
-    set_expr = ",".join(f"{c}=?" for c in cols)
-    vals = [row.get(c) for c in cols]
-    sql = f"UPDATE {table} SET {set_expr} WHERE {where_key}=?"
-    logger.warning(f"[DB DYNAMIC UPDATE] {table}: using cols(non-null)={cols}")
-    conn.execute(sql, tuple(vals + [row[where_key]]))
+def _split_role(role: str) -> Tuple[str, str]:
+    """'leader:СВС' -> ('leader', 'СВС'); 'admin' -> ('admin', '')."""
+    name, _, group = role.partition(":")
+    return name, group
 
-def db_upsert_user(telegram_user_id: int, phone: str, full_name: str, roles_csv: str) -> None:
-    with db() as conn:
-        conn.execute("""
-            INSERT INTO users(telegram_user_id, phone_e164, full_name, roles, verified_at, active)
-            VALUES (?, ?, ?, ?, ?, 1)
-            ON CONFLICT(telegram_user_id) DO UPDATE SET
-                phone_e164=excluded.phone_e164,
-                full_name=excluded.full_name,
-                roles=excluded.roles,
-                verified_at=excluded.verified_at,
-                active=1
-        """, (telegram_user_id, phone, full_name, roles_csv, iso_now()))
+def _join_role(name: str, group: str) -> str:
+    return f"{name}:{group}" if group else name
 
-def db_get_user_roles(telegram_user_id: int) -> Set[str]:
-    with db() as conn:
-        r = conn.execute("SELECT roles, active FROM users WHERE telegram_user_id=?", (telegram_user_id,)).fetchone()
-        if not r or r["active"] != 1:
-            return set()
-        roles_csv = r["roles"] or ""
-        return {x.strip() for x in roles_csv.split(",") if x.strip()}
+def _role_rows(telegram_user_id: int, roles_csv: str) -> List[Tuple[int, str, str]]:
+    return [(telegram_user_id, *_split_role(x.strip())) for x in (roles_csv or "").split(",") if x.strip()]
 
-def db_find_users_by_role_prefix(prefix: str) -> List[sqlite3.Row]:
-    with db() as conn:
-        cur = conn.execute("SELECT * FROM users WHERE active=1 AND roles LIKE ?", (f"%{prefix}%",))
+def _migrate_user_roles(conn: sqlite3.Connection) -> None:
+    """Однократный перенос users.roles (CSV) в нормализованную user_roles."""
+    if conn.execute("SELECT 1 FROM user_roles LIMIT 1").fetchone():
+        return
+    rows: List[Tuple[int, str, str]] = []
+    for r in conn.execute("SELECT telegram_user_id, roles FROM users"):
+        rows.extend(_role_rows(r["telegram_user_id"], r["roles"]))
+    if rows:
+        conn.executemany("INSERT OR IGNORE INTO user_roles(telegram_user_id, role, group_name) VALUES(?, ?, ?)", rows)
+        logger.info(f"[DB MIGRATION] user_roles: migrated {len(rows)} roles from users.roles")
+
+def _upsert_user(conn: sqlite3.Connection, telegram_user_id: int, phone: str, full_name: str, roles_csv: str) -> None:
+    conn.execute("""
+        INSERT INTO users(telegram_user_id, phone_e164, full_name, roles, verified_at, active)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT(telegram_user_id) DO UPDATE SET
+            phone_e164=excluded.phone_e164,
+            full_name=excluded.full_name,
+            roles=excluded.roles,
+            verified_at=excluded.verified_at,
+            active=1
+    """, (telegram_user_id, phone, full_name, roles_csv, iso_now()))
+    conn.execute("DELETE FROM user_roles WHERE telegram_user_id=?", (telegram_user_id,))
+    conn.executemany("INSERT OR IGNORE INTO user_roles(telegram_user_id, role, group_name) VALUES(?, ?, ?)",
+                     _role_rows(telegram_user_id, roles_csv))
+
+async def db_upsert_user(telegram_user_id: int, phone: str, full_name: str, roles_csv: str) -> None:
+    await db_write(_upsert_user, telegram_user_id, phone, full_name, roles_csv)
+
+def db_get_user_roles(telegram_user_id: int) -> Set[str]:
+    with db_read() as conn:
+        cur = conn.execute("""
+            SELECT r.role, r.group_name
+            FROM users u JOIN user_roles r ON r.telegram_user_id = u.telegram_user_id
+            WHERE u.telegram_user_id=? AND u.active=1
+        """, (telegram_user_id,))
+        return {_join_role(r["role"], r["group_name"]) for r in cur.fetchall()}
+
+def db_find_users_by_role(role: str, group: str = "") -> List[sqlite3.Row]:
+    """Активные пользователи с ролью role (в группе group) — поиск по индексу user_roles."""
+    with db_read() as conn:
+        cur = conn.execute("""
+            SELECT u.*
+            FROM user_roles r JOIN users u ON u.telegram_user_id = r.telegram_user_id
+            WHERE r.role=? AND r.group_name=? AND u.active=1
+        """, (role, group))
         return cur.fetchall()
 
-def db_insert_event(ev: Dict[str, Any]) -> None:
-    with db() as conn:
-        conn.execute("""
-            INSERT INTO ticket_events(ticket_id, event, ts_utc, author_id, executor_id, group_name, category, payload_json)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            ev.get("ticket_id") or ev.get("id"),
-            ev["event"],
-            ev.get("ts") or iso_now(),
-            ev.get("submitter_id"),
-            ev.get("executor_id"),
-            (ev.get("classification") or {}).get("group") or ev.get("group"),
-            (ev.get("classification") or {}).get("category") or ev.get("category"),
-            json.dumps(ev, ensure_ascii=False)
-        ))
-
-def db_upsert_ticket_snapshot(t: Dict[str, Any]) -> None:
-    now = iso_now()
-    row = {
-        "ticket_id": t["id"],
-        "author_id": t.get("submitter_id"),
-        "author_name": t.get("submitter_name"),
-        "text": t.get("text"),
-        "group_name": (t.get("classification") or {}).get("group"),
-        "initial_group": t.get("initial_group"),
-        "category": (t.get("classification") or {}).get("category"),
-        "created_ts": t.get("created_ts"),
-        "queued_ts": t.get("queued_ts"),
-        "accepted_ts": t.get("accepted_ts"),
-        "rejected_ts": t.get("rejected_ts"),
-        "closed_ts": t.get("closed_ts"),
-        "final_status": t.get("status"),
-        "executor_id": t.get("executor_id"),
-        "executor_name": t.get("executor_name"),
-        "reject_reason_code": t.get("reject_reason_code"),
-        "reject_comment": t.get("reject_comment"),
-        "leader_id": t.get("leader_id"),
-        "leader_name": t.get("leader_name"),
-        "leader_decision_ts": t.get("leader_decision_ts"),
-        "rerouted_to_group": t.get("rerouted_to_group"),
-        "rerouted_ts": t.get("rerouted_ts"),
-        "clarify_question": t.get("clarify_question"),
-        "clarify_requested_ts": t.get("clarify_requested_ts"),
-        "clarify_answer": t.get("clarify_answer"),
-        "clarify_answered_ts": t.get("clarify_answered_ts"),
-        "group_chat_id": t.get("group_chat_id"),
-        "group_message_id": t.get("group_message_id"),
-        "updated_ts": now,
+SQL_INSERT_EVENT = """
+    INSERT INTO ticket_events(ticket_id, event, ts_utc, author_id, executor_id, group_name, category, payload_json)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# payload_json хранит только то, чего нет в колонках ticket_events; крупные
+# payload'ы (в основном new_text с текстом заявки) — zlib-сжатым BLOB'ом.
+EVENT_PAYLOAD_COMPRESS_MIN = 1024     # байт JSON; None — не сжимать
+_EVENT_COLUMN_KEYS = ("event", "ticket_id", "id", "ts", "submitter_id", "executor_id",
+                      "group", "category", "classification")
+
+def _encode_payload(payload: Dict[str, Any]) -> Any:
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    if EVENT_PAYLOAD_COMPRESS_MIN is not None and len(raw) >= EVENT_PAYLOAD_COMPRESS_MIN:
+        return zlib.compress(raw.encode("utf-8"))
+    return raw
+
+def _decode_payload(value: Any) -> Dict[str, Any]:
+    if not value:
+        return {}
+    if isinstance(value, bytes):
+        value = zlib.decompress(value).decode("utf-8")
+    return json.loads(value)
+
+def _event_row(ev: Dict[str, Any]) -> tuple:
+    cls = ev.get("classification") or {}
+    payload = {k: v for k, v in ev.items() if k not in _EVENT_COLUMN_KEYS and v is not None}
+    return (
+        ev.get("ticket_id") or ev.get("id"),
+        ev["event"],
+        ev.get("ts") or iso_now(),
+        ev.get("submitter_id"),
+        ev.get("executor_id"),
+        cls.get("group") or ev.get("group"),
+        cls.get("category") or ev.get("category"),
+        _encode_payload(payload),
+    )
+
+def _insert_event(conn: sqlite3.Connection, ev: Dict[str, Any]) -> None:
+    conn.execute(SQL_INSERT_EVENT, _event_row(ev))
+
+def _event_from_row(r: sqlite3.Row) -> Dict[str, Any]:
+    """Обратное к _event_row: колонки + распакованный payload."""
+    ev = {
+        "event": r["event"],
+        "ticket_id": r["ticket_id"],
+        "ts": r["ts_utc"],
+        "submitter_id": r["author_id"],
+        "executor_id": r["executor_id"],
+        "group": r["group_name"],
+        "category": r["category"],
     }
-    with db() as conn:
-        _ensure_columns(conn, "tickets", TICKETS_EXPECTED_COLS)
-        existed = conn.execute("SELECT 1 FROM tickets WHERE ticket_id=?", (t["id"],)).fetchone()
-        try:
-            if existed:
-                _dynamic_update(conn, "tickets", row, "ticket_id", TICKETS_EXPECTED_COLS)
+    ev = {k: v for k, v in ev.items() if v is not None}
+    ev.update(_decode_payload(r["payload_json"]))
+    return ev
+
+def db_load_ticket_events(ticket_id: str) -> List[Dict[str, Any]]:
+    with db_read() as conn:
+        cur = conn.execute("SELECT * FROM ticket_events WHERE ticket_id=? ORDER BY ts_utc, id", (ticket_id,))
+        return [_event_from_row(r) for r in cur.fetchall()]
+
+def ticket_view_from_events(events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Полное состояние заявки по её событиям: каждое событие несёт только
+    изменившиеся поля, поэтому достаточно наложить их по порядку. Таймстемпы
+    этапов в payload не пишутся — берём ts события этапа (см. _REPLAY_EVENT_STAGE).
+    Используется /ticket_history."""
+    view: Dict[str, Any] = {}
+    for ev in events:
+        view.update(ev)
+        if ev["event"] == "rerouted":
+            # перенаправление снимает исполнителя (как и в снапшоте); старые события
+            # писали отказавшегося исполнителя в executor_id
+            view.pop("executor_name", None)
+            view.pop("executor_id", None)
+            if "executor_id" in ev:
+                view.setdefault("rejected_by", ev["executor_id"])
+        stage_col = _REPLAY_EVENT_STAGE.get(ev["event"], (None, None))[0]
+        if stage_col and ev.get("ts"):
+            if stage_col in REPLAY_FIRST_WINS_COLS:
+                view.setdefault(stage_col, ev["ts"])
             else:
-                _dynamic_insert(conn, "tickets", row, TICKETS_EXPECTED_COLS)
-        except sqlite3.OperationalError as e:
-            logger.error(f"[DB FALLBACK] tickets upsert failed: {e}")
-            _dynamic_update(conn, "tickets", row, "ticket_id", TICKETS_EXPECTED_COLS)
-
-def db_touch_ticket_timestamp(ticket_id: str, field: str, ts: Optional[str] = None) -> None:
-    val = ts or iso_now()
+                view[stage_col] = ev["ts"]
+    view.pop("event", None)
+    view.pop("ts", None)
+    if events:
+        view["last_event"] = events[-1]["event"]
+        view["last_event_ts"] = events[-1].get("ts")
+    return view
+
+def db_load_ticket(ticket_id: str) -> Optional[Ticket]:
+    with db_read() as conn:
+        r = conn.execute("SELECT * FROM tickets WHERE ticket_id=?", (ticket_id,)).fetchone()
+        return Ticket.from_row(r) if r else None
+
+def db_load_open_tickets() -> List[Ticket]:
+    with db_read() as conn:
+        cur = conn.execute(REPORT_QUERIES["open_tickets"][0], OPEN_STATUSES)
+        return [Ticket.from_row(r) for r in cur.fetchall()]
+
+def _epoch_iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, UTC).isoformat(timespec="seconds")
+
+def _pending_reply_row(key: Tuple[int, int], ctx: Dict[str, Any], expires: float) -> tuple:
+    return (key[0], key[1], ctx["type"], ctx["ticket_id"], ctx.get("executor_id"),
+            json.dumps(ctx, ensure_ascii=False), iso_now(), _epoch_iso(expires))
+
+def _pending_reply_upsert(conn: sqlite3.Connection, row: tuple) -> None:
+    conn.execute("""
+        INSERT INTO pending_replies(chat_id, message_id, kind, ticket_id, executor_id, payload_json, created_ts, expires_ts)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, message_id) DO UPDATE SET
+            kind=excluded.kind, ticket_id=excluded.ticket_id, executor_id=excluded.executor_id,
+            payload_json=excluded.payload_json, expires_ts=excluded.expires_ts
+    """, row)
+
+def _pending_reply_delete(conn: sqlite3.Connection, key: Tuple[int, int]) -> None:
+    conn.execute("DELETE FROM pending_replies WHERE chat_id=? AND message_id=?", key)
+
+def db_get_pending_reply(key: Tuple[int, int]) -> Optional[Tuple[float, Dict[str, Any]]]:
+    """(expires_epoch, ctx) неистёкшего ожидания по (chat_id, message_id) или None."""
+    with db_read() as conn:
+        r = conn.execute("""
+            SELECT payload_json, expires_ts FROM pending_replies
+            WHERE chat_id=? AND message_id=? AND expires_ts > ?
+        """, (key[0], key[1], iso_now())).fetchone()
+    if not r:
+        return None
+    return _parse_iso(r["expires_ts"]).timestamp(), json.loads(r["payload_json"])
+
+def db_find_pending_reply(kind: str, ticket_id: str, executor_id: Optional[int]) -> Optional[Tuple[int, int]]:
+    """(chat_id, message_id) неистёкшего ожидания по idx_pending_ticket или None."""
+    with db_read() as conn:
+        r = conn.execute("""
+            SELECT chat_id, message_id FROM pending_replies
+            WHERE ticket_id=? AND kind=? AND executor_id IS ? AND expires_ts > ?
+            ORDER BY created_ts DESC LIMIT 1
+        """, (ticket_id, kind, executor_id, iso_now())).fetchone()
+    return (r["chat_id"], r["message_id"]) if r else None
+
+def db_purge_expired_replies() -> int:
     with db() as conn:
-        if field not in _get_table_columns(conn, "tickets"):
-            logger.warning(f"[DB MIGRATION] Adding missing column tickets.{field} TEXT (touch)")
-            conn.execute(f"ALTER TABLE tickets ADD COLUMN {field} TEXT")
-        conn.execute(f"UPDATE tickets SET {field}=?, updated_ts=? WHERE ticket_id=?", (val, iso_now(), ticket_id))
+        return conn.execute("DELETE FROM pending_replies WHERE expires_ts <= ?", (iso_now(),)).rowcount
+
+def _ticket_row(t: Ticket) -> tuple:
+    row = t.to_row()
+    return tuple(row.get(c) for c in SCHEMA.tickets_cols)
+
+def _upsert_ticket_snapshot(conn: sqlite3.Connection, row: tuple) -> None:
+    conn.execute(SCHEMA.tickets_upsert_sql, row)
+
+def _touch_ticket_timestamp(conn: sqlite3.Connection, ticket_id: str, field: str, ts: str) -> None:
+    conn.execute(f"UPDATE tickets SET {field}=?, updated_ts=? WHERE ticket_id=?", (ts, iso_now(), ticket_id))
+
+def _ticket_transition(conn: sqlite3.Connection, ticket_id: str, row: tuple,
+                       stamp: Optional[Tuple[str, str]] = None) -> None:
+    """Шаг жизненного цикла заявки одной транзакцией: снапшот + таймстемп
+    (строка события идёт в общий executemany пачки). Один commit вместо трёх,
+    и таблицы не расходятся при падении посередине."""
+    _upsert_ticket_snapshot(conn, row)
+    if stamp:
+        _touch_ticket_timestamp(conn, ticket_id, *stamp)
+
+async def record_ticket_transition(t: Ticket, event: Optional[Dict[str, Any]], ts_field: Optional[str] = None) -> None:
+    """То же через поток записи. Строку снапшота и событие собираем здесь, в loop:
+    Ticket изменяемый, и к моменту выполнения пачки хендлеры могли его уже поменять."""
+    stamp = None
+    if ts_field:
+        if not SCHEMA.has("tickets", ts_field):
+            # DDL во время записи не делаем — новые колонки добавляются только миграциями
+            raise ValueError(f"unknown tickets column: {ts_field}")
+        stamp = (ts_field, iso_now())
+    events = [event] if event else []
+    await db_write(_ticket_transition, t.id, _ticket_row(t), stamp, events=events)
+
+async def save_ticket_snapshot(t: Ticket) -> None:
+    await db_write(_upsert_ticket_snapshot, _ticket_row(t))
+
+# ============================================
+# SQLITE: ОТЧЁТНЫЕ ЗАПРОСЫ
+# ============================================
+
+OPEN_STATUSES = ("created", "queued", "accepted", "clarifying")
+
+_EXPORT_COLS = """
+    ticket_id, initial_group, group_name AS "group", category,
+    author_id, author_name, executor_id, executor_name,
+    created_ts, queued_ts, accepted_ts, rejected_ts, closed_ts,
+    final_status, reject_reason_code, reject_comment, leader_name, rerouted_to_group,
+    clarify_question, clarify_requested_ts, clarify_answer, clarify_answered_ts"""
+
+# Именованные запросы отчётов/экспорта: (SQL, пример параметров для EXPLAIN).
+# Каждый обязан идти по индексу — проверяет db_check_query_plans().
+REPORT_QUERIES: Dict[str, Tuple[str, tuple]] = {
+    "export_all": (
+        f"SELECT {_EXPORT_COLS} FROM tickets ORDER BY COALESCE(created_ts, updated_ts) ASC",
+        (),
+    ),
+    "export_all_by_updated": (
+        f"SELECT {_EXPORT_COLS}, updated_ts FROM tickets ORDER BY updated_ts ASC",
+        (),
+    ),
+    "export_since": (
+        f"SELECT {_EXPORT_COLS}, updated_ts FROM tickets WHERE updated_ts > ? ORDER BY updated_ts ASC",
+        ("1970-01-01T00:00:00+00:00",),
+    ),
+    "open_by_group": (
+        f"SELECT group_name, COUNT(*) AS n FROM tickets "
+        f"WHERE final_status IN ({','.join('?' for _ in OPEN_STATUSES)}) GROUP BY group_name",
+        OPEN_STATUSES,
+    ),
+    "open_tickets": (
+        f"SELECT * FROM tickets WHERE final_status IN ({','.join('?' for _ in OPEN_STATUSES)})",
+        OPEN_STATUSES,
+    ),
+    "executor_open": (
+        f"SELECT COUNT(*) AS n FROM tickets "
+        f"WHERE executor_id=? AND final_status IN ({','.join('?' for _ in OPEN_STATUSES)})",
+        (0, *OPEN_STATUSES),
+    ),
+}
 
 def db_fetch_tickets_rows() -> List[Dict[str, Any]]:
-    with db() as conn:
-        cur = conn.execute("""
-            SELECT ticket_id, initial_group, group_name AS "group", category,
-                   author_id, author_name, executor_id, executor_name,
-                   created_ts, queued_ts, accepted_ts, rejected_ts, closed_ts,
-                   final_status, reject_reason_code, reject_comment, leader_name, rerouted_to_group,
-                   clarify_question, clarify_requested_ts, clarify_answer, clarify_answered_ts
-            FROM tickets ORDER BY COALESCE(created_ts, updated_ts) ASC
-        """)
+    with db_read() as conn:
+        cur = conn.execute(REPORT_QUERIES["export_all"][0])
         return [dict(r) for r in cur.fetchall()]
 
-def db_update_from_events() -> None:
-    with db() as conn:
-        cur = conn.execute("""
-            SELECT ticket_id,
-                   MIN(CASE WHEN event='new_text' THEN ts_utc END) AS created_ts,
-                   MIN(CASE WHEN event='queued_to_group' THEN ts_utc END) AS queued_ts,
-                   MIN(CASE WHEN event='accepted' THEN ts_utc END) AS accepted_ts,
-                   MIN(CASE WHEN event='rejected' THEN ts_utc END) AS rejected_ts,
-                   MIN(CASE WHEN event='closed_by_executor' THEN ts_utc END) AS closed_ts
-            FROM ticket_events
-            GROUP BY ticket_id
-        """)
-        rows = cur.fetchall()
-        for r in rows:
-            final_status = None
-            if r["closed_ts"]:
-                final_status = "closed"
-            elif r["rejected_ts"]:
-                final_status = "rejected"
-            elif r["accepted_ts"]:
-                final_status = "accepted"
-            elif r["queued_ts"]:
-                final_status = "queued"
-            elif r["created_ts"]:
-                final_status = "created"
-            if final_status:
-                conn.execute("""
-                    UPDATE tickets SET created_ts=COALESCE(created_ts, ?),
-                                       queued_ts=COALESCE(queued_ts, ?),
-                                       accepted_ts=COALESCE(accepted_ts, ?),
-                                       rejected_ts=COALESCE(rejected_ts, ?),
-                                       closed_ts=COALESCE(closed_ts, ?),
-                                       final_status=?,
-                                       updated_ts=?
-                    WHERE ticket_id=?
-                """, (r["created_ts"], r["queued_ts"], r["accepted_ts"], r["rejected_ts"], r["closed_ts"],
-                      final_status, iso_now(), r["ticket_id"]))
+def db_count_open_tickets_by_group() -> Dict[str, int]:
+    with db_read() as conn:
+        cur = conn.execute(REPORT_QUERIES["open_by_group"][0], OPEN_STATUSES)
+        return {r["group_name"] or "-": r["n"] for r in cur.fetchall()}
+
+def db_count_executor_open(executor_id: int) -> int:
+    with db_read() as conn:
+        return conn.execute(REPORT_QUERIES["executor_open"][0], (executor_id, *OPEN_STATUSES)).fetchone()["n"]
+
+def db_check_query_plans() -> List[str]:
+    """EXPLAIN QUERY PLAN по каждому запросу из REPORT_QUERIES.
+    Возвращает список проблем (полный скан таблицы без индекса); пустой — всё ок."""
+    problems: List[str] = []
+    with db_read() as conn:
+        for name, (sql, params) in REPORT_QUERIES.items():
+            details = [r["detail"] for r in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+            for d in details:
+                if d.startswith("SCAN ") and " USING " not in d:
+                    problems.append(f"{name}: {d}")
+            logger.debug(f"[DB PLAN] {name}: {details}")
+    return problems
+
+RECONCILE_SYSTEM = "events_reconcile"
+RECONCILE_BATCH_EVENTS = 5000
+RECONCILE_BATCH_TICKETS = 500     # заявок на один IN (...) — ниже лимита параметров SQLite
+RECONCILE_STAGE_COLS = ("created_ts", "queued_ts", "accepted_ts", "rejected_ts", "closed_ts")
+RECONCILE_TERMINAL = ("closed", "rejected")
+
+# Таймстемпы этапов по всей истории заявки — в той же семантике, что и снапшот:
+# переход перезаписывает колонку (см. record_ticket_transition), поэтому берём
+# последнее событие этапа; перенаправление тоже двигает queued_ts.
+_RECONCILE_AGG_SQL = """
+    SELECT ticket_id,
+           MIN(CASE WHEN event='new_text' THEN ts_utc END) AS created_ts,
+           MAX(CASE WHEN event IN ('queued_to_group', 'rerouted') THEN ts_utc END) AS queued_ts,
+           MAX(CASE WHEN event='accepted' THEN ts_utc END) AS accepted_ts,
+           MAX(CASE WHEN event='rejected' THEN ts_utc END) AS rejected_ts,
+           MAX(CASE WHEN event='closed_by_executor' THEN ts_utc END) AS closed_ts,
+           MAX(CASE WHEN event='accepted' THEN id END) AS last_accepted_id,
+           MAX(CASE WHEN event='rerouted' THEN id END) AS last_rerouted_id
+    FROM ticket_events
+    WHERE ticket_id IN ({marks})
+    GROUP BY ticket_id
+"""
+
+def _status_from_events(r: sqlite3.Row) -> Optional[str]:
+    if r["closed_ts"]:
+        return "closed"
+    if r["rejected_ts"]:
+        return "rejected"
+    if r["accepted_ts"] and (r["last_rerouted_id"] or 0) < r["last_accepted_id"]:
+        return "accepted"
+    if r["queued_ts"]:
+        return "queued"
+    if r["created_ts"]:
+        return "created"
+    return None
+
+def _reconcile_tickets(conn: sqlite3.Connection, ticket_ids: List[str], full: bool) -> int:
+    """Сверить снапшоты заявок с их событиями (по всей истории каждой заявки).
+    Пишет только изменившиеся строки; возвращает их число."""
+    marks = ",".join("?" for _ in ticket_ids)
+    agg = {r["ticket_id"]: r for r in conn.execute(_RECONCILE_AGG_SQL.format(marks=marks), ticket_ids)}
+    cols = ",".join(RECONCILE_STAGE_COLS)
+    now = iso_now()
+    params = []
+    for snap in conn.execute(f"SELECT ticket_id, {cols}, final_status FROM tickets WHERE ticket_id IN ({marks})",
+                             ticket_ids).fetchall():
+        ev = agg.get(snap["ticket_id"])
+        if ev is None:
+            continue
+        if full:
+            stages = [ev[c] or snap[c] for c in RECONCILE_STAGE_COLS]
+        else:
+            stages = [snap[c] or ev[c] for c in RECONCILE_STAGE_COLS]
+        status = snap["final_status"]
+        derived = _status_from_events(ev)
+        if not status or derived in RECONCILE_TERMINAL:
+            status = derived or status
+        if stages != [snap[c] for c in RECONCILE_STAGE_COLS] or status != snap["final_status"]:
+            params.append((*stages, status, now, snap["ticket_id"]))
+    conn.executemany(f"""
+        UPDATE tickets SET {", ".join(f"{c}=?" for c in RECONCILE_STAGE_COLS)}, final_status=?, updated_ts=?
+        WHERE ticket_id=?
+    """, params)
+    return len(params)
+
+def db_update_from_events(full: bool = False) -> None:
+    """Досчитать снапшоты tickets по ticket_events.
+
+    Снапшот пишется в одной транзакции с событием, поэтому его final_status
+    главнее: из событий он заполняется, если NULL, и исправляется только на
+    закрыта/отклонена — clarifying и перенаправление событиями не восстановить.
+    Таймстемпы этапов из событий заполняют пустые колонки; в режиме full —
+    ещё и исправляют записанные. Статус и таймстемпы считаются по всей истории
+    заявки, updated_ts меняется только у реально изменённых строк.
+
+    Инкрементально: заявки с событиями новее high-water mark (sync_state.cursor),
+    пачками по RECONCILE_BATCH_EVENTS id; mark двигается в той же транзакции,
+    что и UPDATE. full=True — все заявки с событиями (см. --full-reconcile).
+    """
+    last_id = 0 if full else (db_get_cursor(RECONCILE_SYSTEM) or 0)
+    with db_read() as conn:
+        max_id = conn.execute("SELECT MAX(id) FROM ticket_events").fetchone()[0] or 0
+    if max_id <= last_id:
+        logger.info(f"[DB RECONCILE] up to date (cursor={last_id})")
+        return
+    logger.info(f"[DB RECONCILE] events {last_id + 1}..{max_id} ({'full' if full else 'incremental'})")
+    updated = 0
+    if full:
+        with db_read() as conn:
+            ids = [r[0] for r in conn.execute("SELECT DISTINCT ticket_id FROM ticket_events WHERE id <= ?", (max_id,))]
+        for k in range(0, len(ids), RECONCILE_BATCH_TICKETS):
+            with db() as conn:
+                updated += _reconcile_tickets(conn, ids[k:k + RECONCILE_BATCH_TICKETS], full=True)
+        with db() as conn:
+            _set_cursor(conn, RECONCILE_SYSTEM, max_id)
+    while not full and last_id < max_id:
+        upper = min(last_id + RECONCILE_BATCH_EVENTS, max_id)
+        with db() as conn:
+            ids = [r[0] for r in conn.execute("SELECT DISTINCT ticket_id FROM ticket_events WHERE id > ? AND id <= ?",
+                                              (last_id, upper))]
+            for k in range(0, len(ids), RECONCILE_BATCH_TICKETS):
+                updated += _reconcile_tickets(conn, ids[k:k + RECONCILE_BATCH_TICKETS], full=False)
+            _set_cursor(conn, RECONCILE_SYSTEM, upper)
+        last_id = upper
+    logger.info(f"[DB RECONCILE] done: {updated} ticket updates, cursor={max_id}")
+
+def db_get_cursor(system: str) -> Optional[int]:
+    with db_read() as conn:
+        r = conn.execute("SELECT cursor FROM sync_state WHERE system=?", (system,)).fetchone()
+        return int(r["cursor"]) if r and r["cursor"] is not None else None
+
+def _set_cursor(conn: sqlite3.Connection, system: str, value: int) -> None:
+    conn.execute("""
+        INSERT INTO sync_state(system, cursor) VALUES(?, ?)
+        ON CONFLICT(system) DO UPDATE SET cursor=excluded.cursor
+    """, (system, value))
 
 def db_get_last_export_ts(system: str) -> Optional[str]:
-    with db() as conn:
+    with db_read() as conn:
         r = conn.execute("SELECT last_export_ts FROM sync_state WHERE system=?", (system,)).fetchone()
         return r["last_export_ts"] if r and r["last_export_ts"] else None
 
@@ -410,19 +1464,238 @@ def db_set_last_export_ts(system: str, ts: str) -> None:
         """, (system, ts))
 
 def db_fetch_tickets_since(ts_iso: Optional[str]) -> List[Dict[str, Any]]:
-    query = """
-        SELECT ticket_id, initial_group, group_name AS "group", category,
-               author_id, author_name, executor_id, executor_name,
-               created_ts, queued_ts, accepted_ts, rejected_ts, closed_ts,
-               final_status, reject_reason_code, reject_comment, leader_name, rerouted_to_group,
-               clarify_question, clarify_requested_ts, clarify_answer, clarify_answered_ts, updated_ts
-        FROM tickets
-        WHERE (? IS NULL OR updated_ts > ?)
-        ORDER BY updated_ts ASC
+    # Два отдельных запроса вместо «(? IS NULL OR updated_ts > ?)» — иначе индекс не используется.
+    with db_read() as conn:
+        if ts_iso is None:
+            cur = conn.execute(REPORT_QUERIES["export_all_by_updated"][0])
+        else:
+            cur = conn.execute(REPORT_QUERIES["export_since"][0], (ts_iso,))
+        return [dict(r) for r in cur.fetchall()]
+
+# ============================================
+# ИМПОРТ ИСТОРИИ ИЗ JSONL
+# ============================================
+
+REPLAY_BATCH_LINES = 5000
+REPLAY_FIRST_WINS_COLS = ("created_ts", "queued_ts", "accepted_ts", "rejected_ts", "closed_ts")
+
+# событие -> (колонка-таймстемп этапа, итоговый статус)
+_REPLAY_EVENT_STAGE = {
+    "new_text": ("created_ts", "created"),
+    "queued_to_group": ("queued_ts", "queued"),
+    "accepted": ("accepted_ts", "accepted"),
+    "rejected": ("rejected_ts", "rejected"),
+    "closed_by_executor": ("closed_ts", "closed"),
+    "rerouted": ("rerouted_ts", "queued"),
+}
+
+def _replay_event(rec: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Запись JSONL любой сборки -> событие в формате текущей (см. Ticket.event)."""
+    t_id = rec.get("ticket_id") or rec.get("id")
+    if not t_id or not rec.get("event"):
+        return None
+    ev = dict(rec)
+    ev.pop("id", None)
+    ev.pop("event_id", None)    # id строки в БД-источнике (зеркало JsonlExporter)
+    ev["ticket_id"] = t_id
+    cls = ev.pop("classification", None)
+    if cls:
+        # bot_8_2 и ранние v2 писали всю классификацию с полной картой hits
+        ev.setdefault("group", cls.get("group"))
+        ev.setdefault("category", cls.get("category"))
+        ev.setdefault("hits", top_hits(cls.get("hits") or {}))
+    if "comment" in ev and "reject_comment" not in ev:
+        ev["reject_comment"] = ev.pop("comment")
+    if ev.get("status") == "new":
+        ev["status"] = "created"
+    if ev["event"] == "rerouted" and "executor_id" in ev:
+        # отказавшийся исполнитель, а не текущий (см. ticket_view_from_events)
+        ev.setdefault("rejected_by", ev.pop("executor_id"))
+    return ev
+
+def _replay_snapshot(ev: Dict[str, Any], now: str) -> Dict[str, Any]:
+    stage_col, status = _REPLAY_EVENT_STAGE.get(ev["event"], (None, None))
+    row = {
+        "ticket_id": ev["ticket_id"],
+        "author_id": ev.get("submitter_id"),
+        "author_name": ev.get("submitter_name"),
+        "submitter_chat_id": ev.get("submitter_chat_id"),
+        "text": ev.get("text"),
+        "group_name": ev.get("to_group") or ev.get("rerouted_to_group") or ev.get("group"),
+        "category": ev.get("category"),
+        "initial_group": ev.get("initial_group"),
+        "executor_id": ev.get("executor_id"),
+        "executor_name": ev.get("executor_name"),
+        "reject_reason_code": ev.get("reject_reason_code"),
+        "reject_comment": ev.get("reject_comment"),
+        "leader_id": ev.get("leader_id"),
+        "leader_name": ev.get("leader_name"),
+        "rerouted_to_group": ev.get("rerouted_to_group") or ev.get("to_group"),
+        "final_status": status,
+        "updated_ts": now,
+    }
+    if stage_col:
+        row[stage_col] = ev.get("ts")
+    return row
+
+def _merge_snapshot(acc: Dict[str, Any], row: Dict[str, Any]) -> None:
+    for k, v in row.items():
+        if v is None:
+            continue
+        if k in REPLAY_FIRST_WINS_COLS and acc.get(k):
+            continue
+        acc[k] = v
+
+def _replay_flush(conn: sqlite3.Connection, rows: List[tuple], snaps: Dict[str, Dict[str, Any]],
+                  system: str, offset: int) -> None:
+    conn.executemany(SQL_INSERT_EVENT, rows)
+    conn.executemany(SCHEMA.tickets_replay_sql,
+                     [tuple(snap.get(c) for c in SCHEMA.tickets_cols) for snap in snaps.values()])
+    _set_cursor(conn, system, offset)
+
+def _iter_jsonl_file(path: Path, offset: int) -> Iterator[Tuple[Optional[Dict[str, Any]], int]]:
+    """(запись или None для битой строки, байтовое смещение после неё)."""
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break  # строка ещё дописывается
+            offset += len(raw)
+            line = raw.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line), offset
+            except ValueError:
+                yield None, offset
+
+def _iter_jsonl_segments(base: Path, since: Optional[str], until: Optional[str],
+                         done: int) -> Iterator[Tuple[Optional[Dict[str, Any]], int]]:
+    """(запись, номер записи в интервале); первые done уже импортированы."""
+    for n, rec in enumerate(iter_jsonl_range(base, since, until), 1):
+        if n > done:
+            yield rec, n
+
+def replay_jsonl(path: Path, batch_lines: int = REPLAY_BATCH_LINES,
+                 since: Optional[str] = None, until: Optional[str] = None) -> int:
+    """Потоковый импорт JSONL в ticket_events + снапшоты tickets.
+
+    path — файл старых сборок (.jsonl/.jsonl.gz) или каталог сегментов
+    (data/events/): тогда читаются только сегменты, пересекающиеся с
+    since..until (см. iter_jsonl_range). В памяти — не больше batch_lines
+    записей; каждая пачка — одна транзакция, в которой же двигается checkpoint
+    (sync_state.cursor, system='jsonl_replay:<путь>[|since..until]'): байтовое
+    смещение для файла, число записей интервала для сегментов. Повторный запуск
+    продолжает с места остановки. Для логов старых сборок и переноса истории
+    в другую БД: события текущей уже есть в ticket_events.
     """
+    system = f"jsonl_replay:{path.resolve()}"
+    if since or until:
+        system += f"|{since or ''}..{until or ''}"
+    position = db_get_cursor(system) or 0
+    if path.is_dir():
+        logger.info(f"[REPLAY] {path} segments {since or '-'}..{until or '-'}, skipping {position} records")
+        records = _iter_jsonl_segments(path / TICKETS_LOG.name, since, until, position)
+    else:
+        logger.info(f"[REPLAY] {path} from byte {position}")
+        records = _iter_jsonl_file(path, position)
+    imported = bad = 0
+    rows: List[tuple] = []
+    snaps: Dict[str, Dict[str, Any]] = {}
+    now = iso_now()
+    for rec, position in records:
+        ev = _replay_event(rec) if isinstance(rec, dict) else None
+        if ev is None:
+            bad += 1
+            continue
+        ts = ev.get("ts") or ""
+        if (since and ts < since) or (until and ts > until):
+            continue
+        rows.append(_event_row(ev))
+        _merge_snapshot(snaps.setdefault(ev["ticket_id"], {}), _replay_snapshot(ev, now))
+        if len(rows) >= batch_lines:
+            with db() as conn:
+                _replay_flush(conn, rows, snaps, system, position)
+            imported += len(rows)
+            rows, snaps = [], {}
+            logger.info(f"[REPLAY] {imported} events, checkpoint {position}")
     with db() as conn:
-        cur = conn.execute(query, (ts_iso, ts_iso))
-        return [dict(r) for r in cur.fetchall()]
+        _replay_flush(conn, rows, snaps, system, position)
+    imported += len(rows)
+    logger.info(f"[REPLAY] done: {imported} events imported, {bad} lines skipped, checkpoint {position}")
+    return imported
+
+# ============================================
+# JSONL-ЗЕРКАЛО ticket_events
+# ============================================
+
+JSONL_EXPORT_SYSTEM = "jsonl_export"
+JSONL_EXPORT_BATCH = 500
+
+class JsonlExporter:
+    """tickets.jsonl как производная от ticket_events.
+
+    Хендлеры пишут событие один раз — в SQLite; этот поток хвостом читает
+    ticket_events по id > cursor и дописывает их в TICKETS_SINK. Cursor
+    (sync_state, system='jsonl_export') сохраняется через DB_WRITER после сброса JSONL,
+    поэтому зеркало не отстаёт и не расходится с БД: после падения
+    возможен лишь повтор последней пачки.
+    """
+
+    def __init__(self, sink: JsonlSink, poll_ms: int = 500):
+        self._sink = sink
+        self.poll_ms = poll_ms
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        if db_get_cursor(JSONL_EXPORT_SYSTEM) is None:
+            # Первый запуск: всё, что уже в БД, прежние сборки писали в JSONL сами
+            with db_read() as conn:
+                max_id = conn.execute("SELECT MAX(id) FROM ticket_events").fetchone()[0] or 0
+            DB_WRITER.submit(_set_cursor, JSONL_EXPORT_SYSTEM, max_id).result()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="jsonl-export", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Остановить с дозаписью всего, что уже закоммичено."""
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def export_pending(self) -> int:
+        last_id = db_get_cursor(JSONL_EXPORT_SYSTEM) or 0
+        total = 0
+        while True:
+            with db_read() as conn:
+                rows = conn.execute("SELECT * FROM ticket_events WHERE id > ? ORDER BY id LIMIT ?",
+                                    (last_id, JSONL_EXPORT_BATCH)).fetchall()
+            if not rows:
+                return total
+            self._sink.write_many([{**_event_from_row(r), "event_id": r["id"]} for r in rows])
+            self._sink.flush()
+            last_id = rows[-1]["id"]
+            # Курсор — через поток записи: у соединения на запись один владелец
+            DB_WRITER.submit(_set_cursor, JSONL_EXPORT_SYSTEM, last_id).result()
+            total += len(rows)
+
+    def _run(self) -> None:
+        while True:
+            stopping = self._stop.wait(self.poll_ms / 1000)
+            try:
+                self.export_pending()
+            except Exception:
+                logger.exception("[JSONL EXPORT] failed")
+            if stopping:
+                return
+
+JSONL_EXPORTER = JsonlExporter(TICKETS_SINK)
 
 # ============================================
 # РОЛИ / ВЕРИФИКАЦИЯ ПО ТЕЛЕФОНУ
@@ -542,6 +1815,7 @@ async def audit_log(bot, text: str) -> None:
 # ЭВРИСТИКИ
 # ============================================
 
+# Встроенный набор правил — действует, пока нет файла правил (RULES_FILE, см. RulesWatcher).
 GROUP_CATEGORIES: Dict[str, List[Dict[str, Any]]] = {
     "СВС": [
         {"title": "Настройка температуры / обдува",
@@ -585,28 +1859,281 @@ GROUP_CATEGORIES: Dict[str, List[Dict[str, Any]]] = {
     ],
 }
 
-def _count_hits(text: str, patterns: List[str]) -> int:
-    t = (text or "").lower()
-    return sum(1 for p in patterns if p.lower() in t)
-
-def _score_category(text: str, title: str, kw: List[str]) -> int:
-    score = _count_hits(text, kw)
-    if fuzz.partial_ratio(title.lower(), (text or "").lower()) >= 85:
-        score += 1
-    return score
+# --- Нормализация текста: один раз на сообщение, общая для всех стадий ---
+
+# Латинские буквы, похожие на кириллические (после casefold), — только внутри
+# слов, где уже есть кириллица: «кондиционеp» с латинской p.
+_HOMOGLYPHS = str.maketrans("aceopxykmthb", "асеорхукмтнв")
+_RE_WORD = re.compile(r"[^\W\d_]+")
+_RE_CYR = re.compile(r"[а-я]")
+_RE_LAT = re.compile(r"[a-z]")
+_RE_REPEATS = re.compile(r"(\w)\1{2,}")          # «холоднооо» -> «холодно»
+_RE_NON_WORD = re.compile(r"[\W_]+")
+# Лёгкий стемминг: самые частые окончания, длинные — первыми; основа не короче
+# STEM_MIN_LEN букв. Слово и его формы сводятся к одной основе («тепло», «теплом»,
+# «теплое» -> «тепл»), а трёхбуквенные основы не образуются: «запах»->«зап»,
+# «вода»->«вод» совпадали бы с «запись», «завод», «водитель».
+STEM_MIN_LEN = 4
+_RU_ENDINGS = tuple(sorted((
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ость", "ости",
+    "ией", "ие", "ия", "ий", "ый", "ой", "ая", "яя", "ое", "ее", "ые", "ую", "юю",
+    "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев", "ей", "ть", "ет", "ит", "ют", "ут", "ат", "ят",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+), key=len, reverse=True))
+_RE_CYR_WORD = re.compile(r"[а-я]{5,}")
+
+def _fold_homoglyphs(m: "re.Match[str]") -> str:
+    w = m.group(0)
+    if not (_RE_CYR.search(w) and _RE_LAT.search(w)):
+        return w
+    folded = w.translate(_HOMOGLYPHS)
+    # остались латинские буквы без двойника — это не опечатка, а смешанное слово
+    return w if _RE_LAT.search(folded) else folded
+
+def _stem(m: "re.Match[str]") -> str:
+    w = m.group(0)
+    for end in _RU_ENDINGS:
+        if w.endswith(end) and len(w) - len(end) >= STEM_MIN_LEN:
+            return w[: -len(end)]
+    return w
+
+def normalize_text(text: Optional[str]) -> str:
+    """casefold, ё->е, латинские двойники -> кириллица, схлопывание повторов букв,
+    пунктуации и пробелов, лёгкий стемминг. Ключевые слова и названия категорий
+    проходят через ту же функцию, поэтому совпадение — по основам."""
+    s = (text or "").casefold().replace("ё", "е")
+    s = _RE_WORD.sub(_fold_homoglyphs, s)
+    s = _RE_REPEATS.sub(r"\1", s)
+    s = _RE_NON_WORD.sub(" ", s).strip()
+    return _RE_CYR_WORD.sub(_stem, s)
+
+FUZZY_TITLE_CUTOFF = 85   # partial_ratio названия категории к тексту: +1 к счёту
+
+class CategoryMatcher:
+    """Скоринг категорий GROUP_CATEGORIES: ключевые слова + нечёткое совпадение названия.
+
+    Ключевые слова — одним регулярным выражением \\b(?=(kw1|kw2|...)) по убыванию
+    длины: lookahead пробует каждое начало слова и не поглощает символы,
+    поэтому находятся и вложенные фразы («дым» внутри «датчик дым»). Слово
+    должно начинаться с основы: «вод» не срабатывает в «завод». В одной
+    позиции regex отдаёт только самое длинное совпадение — более короткие
+    слова-префиксы («температур» для «температурн») добавляет заранее
+    посчитанное префиксное замыкание. Один проход по тексту даёт число
+    сработавших слов по всем категориям.
+
+    Слова и названия категорий нормализуются (normalize_text) один раз при
+    сборке; fuzzy-оценка всех названий — один вызов rapidfuzz.process.extract
+    с score_cutoff. На вход scores() — уже нормализованный текст.
+    """
 
-def classify(text: str) -> Dict[str, Any]:
+    def __init__(self, groups: Dict[str, List[Dict[str, Any]]]):
+        # Версия набора правил: меняется вместе с содержимым, входит в ключ кэша classify
+        self.version = hashlib.sha1(json.dumps(groups, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        self.categories: List[Tuple[str, str]] = []
+        kw_cats: Dict[str, List[int]] = {}
+        for group, cats in groups.items():
+            for c in cats:
+                idx = len(self.categories)
+                self.categories.append((group, c["title"]))
+                # после нормализации разные формы одного слова могут совпасть — считаем один раз
+                for kw in dict.fromkeys(normalize_text(k) for k in c["kw"]):
+                    if kw:
+                        kw_cats.setdefault(kw, []).append(idx)
+        words = sorted(kw_cats, key=len, reverse=True)
+        self._closure = {w: [p for p in words if w.startswith(p)] for w in words}
+        self._kw_cats = kw_cats
+        self._re = re.compile(r"\b(?=(" + "|".join(re.escape(w) for w in words) + "))") if words else None
+        self._titles = [normalize_text(title) for _, title in self.categories]
+
+    def count(self, norm: str) -> List[int]:
+        """Для каждой категории (в порядке self.categories) — сколько её слов есть в тексте."""
+        counts = [0] * len(self.categories)
+        if self._re is None:
+            return counts
+        found: Set[str] = set()
+        for m in self._re.finditer(norm):
+            found.update(self._closure[m.group(1)])
+        for w in found:
+            for idx in self._kw_cats[w]:
+                counts[idx] += 1
+        return counts
+
+    def scores(self, norm: str) -> List[int]:
+        """Итоговый счёт по категориям: слова + 1 за название с partial_ratio >= FUZZY_TITLE_CUTOFF."""
+        scores = self.count(norm)
+        if norm:
+            for _, _, idx in process.extract(norm, self._titles, scorer=fuzz.partial_ratio,
+                                             processor=None, score_cutoff=FUZZY_TITLE_CUTOFF, limit=None):
+                scores[idx] += 1
+        return scores
+
+MATCHER = CategoryMatcher(GROUP_CATEGORIES)
+
+def classify(text: str, norm: Optional[str] = None) -> Dict[str, Any]:
+    """norm — результат normalize_text(text), если уже посчитан (Ticket.normalized).
+
+    Результат кэшируется в CLASSIFY_CACHE по (версия правил, хэш нормализованного
+    текста): повторно присланный текст не скорится заново, а смена правил
+    сама делает старые записи недостижимыми (их вытеснит LRU)."""
+    if norm is None:
+        norm = normalize_text(text)
+    matcher = MATCHER
+    key = (matcher.version, hashlib.blake2b(norm.encode("utf-8"), digest_size=16).digest())
+    cached = CLASSIFY_CACHE.get(key)
+    if cached is None:
+        cached = CLASSIFY_CACHE[key] = _classify_norm(matcher, norm)
+    return {**cached}
+
+def _classify_norm(matcher: CategoryMatcher, norm: str) -> Dict[str, Any]:
     best_group, best_category, best_score = "Неопределено", "Другое", 0
     hits: Dict[str, int] = {}
-    for group, cats in GROUP_CATEGORIES.items():
-        for c in cats:
-            title, kw = c["title"], c["kw"]
-            s = _score_category(text, title, kw)
-            hits[f"{group}:{title}"] = s
-            if s > best_score:
-                best_score, best_group, best_category = s, group, title
+    for (group, title), s in zip(matcher.categories, matcher.scores(norm)):
+        hits[f"{group}:{title}"] = s
+        if s > best_score:
+            best_score, best_group, best_category = s, group, title
     return {"group": best_group, "category": best_category, "confidence": 0.0, "hits": hits}
 
+EVENT_HITS_TOP_K = 3
+
+def top_hits(hits: Dict[str, int], k: int = EVENT_HITS_TOP_K) -> Dict[str, int]:
+    """Сводка для событий: k лучших ненулевых совпадений вместо всей карты."""
+    best = sorted(((s, key) for key, s in hits.items() if s > 0), reverse=True)[:k]
+    return {key: s for s, key in best}
+
+# --- Правила из файла: JSON (YAML — если установлен PyYAML), горячая перезагрузка ---
+
+RULES_POLL_S = 5.0
+_DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def rules_path() -> Path:
+    return Path(os.getenv("RULES_FILE") or DATA_DIR / "rules.json")
+
+def _validate_rules(groups: Any) -> Dict[str, List[Dict[str, Any]]]:
+    if not isinstance(groups, dict) or not groups:
+        raise ValueError("rules: ожидается непустой объект {группа: [категории]}")
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    for group, cats in groups.items():
+        if not isinstance(cats, list):
+            raise ValueError(f"rules: {group}: ожидается список категорий")
+        out[str(group).strip()] = []
+        for c in cats:
+            if not isinstance(c, dict) or not c.get("title") or not isinstance(c.get("kw"), list):
+                raise ValueError(f"rules: {group}: категория без title/kw: {c!r}")
+            out[str(group).strip()].append({"title": str(c["title"]).strip(),
+                                            "kw": [str(k) for k in c["kw"] if str(k).strip()]})
+    return out
+
+def load_rules_file(path: Path) -> Dict[str, List[Dict[str, Any]]]:
+    """{"groups": {...}} или сразу {группа: [...]} — в формате GROUP_CATEGORIES."""
+    raw = path.read_text(encoding="utf-8")
+    if path.suffix.lower() in (".yaml", ".yml"):
+        try:
+            import yaml
+        except Exception:
+            raise ValueError("PyYAML не установлен — используйте JSON") from None
+        data = yaml.safe_load(raw)
+    else:
+        data = json.loads(raw)
+    if isinstance(data, dict) and "groups" in data:
+        data = data["groups"]
+    return _validate_rules(data)
+
+def set_rules(groups: Dict[str, List[Dict[str, Any]]], source: str) -> CategoryMatcher:
+    """Собрать новый матчер целиком и подменить MATCHER одним присваиванием:
+    classify() берёт ссылку один раз, поэтому видит либо старые, либо новые правила."""
+    global MATCHER
+    matcher = CategoryMatcher(groups)
+    if matcher.version != MATCHER.version:
+        MATCHER = matcher
+        logger.info(f"[RULES] {source}: {len(matcher.categories)} categories, version {matcher.version}")
+    return MATCHER
+
+def _expand_variants(phrase: str) -> List[str]:
+    """«проверка/установка оборудования» -> «проверка оборудования», «установка оборудования»."""
+    variants = [""]
+    for word in phrase.split():
+        variants = [f"{v} {alt}".strip() for v in variants for alt in word.split("/") if alt]
+    return variants
+
+def import_rules_docx(docx_path: Path) -> Dict[str, List[Dict[str, Any]]]:
+    """Таблица «Группа / Категория / Слова-маркеры» из КАТЕГОРИИ.docx.
+    Пустая ячейка группы — продолжение предыдущей; «Другое» пропускаем —
+    это и так категория по умолчанию."""
+    with zipfile.ZipFile(docx_path) as z:
+        root = ET.fromstring(z.read("word/document.xml"))
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    group = None
+    for tr in root.iter(f"{_DOCX_NS}tr"):
+        cells = [" ".join("".join(t.text or "" for t in tc.iter(f"{_DOCX_NS}t")).split())
+                 for tc in tr.findall(f"{_DOCX_NS}tc")]
+        if len(cells) < 3 or cells[0] == "Группа":
+            continue
+        group = cells[0] or group
+        title, markers = cells[1], cells[2]
+        if not group or not title or title == "Другое":
+            continue
+        kw: List[str] = []
+        for part in markers.split(","):
+            for v in _expand_variants(part.strip().lower()):
+                if v not in kw:
+                    kw.append(v)
+        groups.setdefault(group, []).append({"title": title, "kw": kw})
+    return _validate_rules(groups)
+
+def write_rules_file(groups: Dict[str, List[Dict[str, Any]]], path: Path) -> None:
+    # через tmp + replace: наблюдатель никогда не прочтёт полузаписанный файл
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({"groups": groups}, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+class RulesWatcher:
+    """Следит за файлом правил (mtime/размер раз в poll_s) и при изменении
+    в фоне пересобирает матчер; ошибка в файле — лог, остаются прежние правила."""
+
+    def __init__(self, poll_s: float = RULES_POLL_S):
+        self.poll_s = poll_s
+        self._sig: Optional[Tuple[int, int]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def check(self) -> bool:
+        path = rules_path()
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return False
+        sig = (st.st_mtime_ns, st.st_size)
+        if sig == self._sig:
+            return False
+        self._sig = sig
+        try:
+            set_rules(load_rules_file(path), path.name)
+        except Exception:
+            logger.exception(f"[RULES] {path} не загружен, остаются текущие правила")
+            return False
+        return True
+
+    def start(self) -> None:
+        self.check()  # первая загрузка — синхронно, до приёма сообщений
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rules-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.poll_s):
+            self.check()
+
+RULES_WATCHER = RulesWatcher()
+
 # ============================================
 # РУССКИЕ СТАТУСЫ
 # ============================================
@@ -630,27 +2157,27 @@ def user_link_html(user_id: int, name: str | None) -> str:
     safe = html_escape(name or "пользователь", quote=False)
     return f'<a href="tg://user?id={user_id}">{safe}</a>'
 
-def ticket_group_text(t: Dict[str, Any]) -> str:
-    submit_link = user_link_html(t["submitter_id"], t.get("submitter_name"))
-    body = html_escape((t.get("text") or "").strip(), quote=False)
+def ticket_group_text(t: Ticket) -> str:
+    submit_link = user_link_html(t.submitter_id, t.submitter_name)
+    body = html_escape((t.text or "").strip(), quote=False)
     parts = [
-        f"🆕 Заявка #{t['id']} (группа: {t['classification']['group']} / категория: {t['classification']['category']})",
+        f"🆕 Заявка #{t.id} (группа: {t.group} / категория: {t.category})",
         f"Автор: {submit_link}",
         "",
         body,
         "",
-        f"Статус: <b>{html_escape(status_ru(t['status']).upper(), quote=False)}</b>",
+        f"Статус: <b>{html_escape(status_ru(t.status).upper(), quote=False)}</b>",
     ]
-    if t.get("executor_id"):
-        parts.append(f"Исполнитель: {user_link_html(t['executor_id'], t.get('executor_name'))}")
-    if t.get("reject_reason_code"):
+    if t.executor_id:
+        parts.append(f"Исполнитель: {user_link_html(t.executor_id, t.executor_name)}")
+    if t.reject_reason_code:
         reasons_ru = {"not_uto":"Не к УТО","other_group":"К другой группе","no_access":"Нет доступа к помещению"}
-        parts.append(f"Причина отклонения: {reasons_ru.get(t['reject_reason_code'], t['reject_reason_code'])}")
-    if t.get("reject_comment"):
-        parts.append(f"Комментарий: {html_escape(t['reject_comment'], quote=False)}")
-    if t.get("clarify_question") and t["status"] == "clarifying":
-        parts.append(f"🔎 На уточнении: {html_escape(t['clarify_question'], False)}")
-    if t.get("pending_reject"):
+        parts.append(f"Причина отклонения: {reasons_ru.get(t.reject_reason_code, t.reject_reason_code)}")
+    if t.reject_comment:
+        parts.append(f"Комментарий: {html_escape(t.reject_comment, quote=False)}")
+    if t.clarify_question and t.status == "clarifying":
+        parts.append(f"🔎 На уточнении: {html_escape(t.clarify_question, False)}")
+    if t.pending_reject:
         parts.append("⏳ Отклонение на согласовании у руководителя.")
     return "\n".join(parts)
 
@@ -719,20 +2246,240 @@ def verify_reply_kb() -> ReplyKeyboardMarkup:
 # СЛУЖЕБНЫЕ СТРУКТУРЫ
 # ============================================
 
-REPLY_WAIT: Dict[Tuple[int, int], Dict[str, Any]] = {}
-CLARIFY_AUTHOR_WAIT: Dict[Tuple[int, int], Dict[str, Any]] = {}
-TICKETS: Dict[str, Dict[str, Any]] = {}
+TICKETS_CACHE_MAX = 2000
+TICKETS_CACHE_TTL_S = 24 * 3600       # после TTL заявка просто перечитывается из БД
+REPLY_WAIT_MAX = 5000                 # в памяти; в pending_replies живут до истечения
+REPLY_WAIT_TTL_S = 24 * 3600          # брошенные запросы комментария
+CLARIFY_WAIT_TTL_S = 3 * 24 * 3600    # автор может ответить на уточнение не сразу
+CLASSIFY_CACHE_MAX = 1000
+
+class BoundedCache:
+    """dict с ограничением: LRU по ёмкости + TTL с момента записи.
+    Считает hits/misses/evictions/expired (см. /cache_stats)."""
+
+    def __init__(self, name: str, max_items: int, ttl_s: Optional[float] = None,
+                 on_evict: Optional[Callable[[Any, Any], None]] = None):
+        self.name = name
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def _alive(self, stored_at: float) -> bool:
+        return self.ttl_s is None or (time.monotonic() - stored_at) < self.ttl_s
+
+    def _drop(self, key: Any) -> None:
+        _, value = self._data.pop(key)
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if not self._alive(item[0]):
+            self._drop(key)
+            self.expired += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def __getitem__(self, key: Any) -> Any:
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = (time.monotonic(), value)
+        while len(self._data) > self.max_items:
+            self._drop(next(iter(self._data)))
+            self.evictions += 1
+
+    def __contains__(self, key: Any) -> bool:
+        item = self._data.get(key)
+        return item is not None and self._alive(item[0])
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        self.purge_expired()
+        return [(k, v) for k, (_, v) in self._data.items()]
+
+    def purge_expired(self) -> int:
+        dead = [k for k, (ts, _) in self._data.items() if not self._alive(ts)]
+        for k in dead:
+            self._drop(k)
+        self.expired += len(dead)
+        return len(dead)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data), "max": self.max_items,
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions, "expired": self.expired,
+        }
+
+class TicketRepository:
+    """Заявки в памяти поверх снапшотов tickets в SQLite.
+
+    - get(): при промахе кэша заявка поднимается из БД, поэтому кнопки на
+      карточках продолжают работать после рестарта бота;
+    - save(): write-through — кэш + снапшот через поток записи;
+    - warm_up(): необязательный прогрев только открытыми заявками.
+    """
+
+    def __init__(self):
+        self._cache = BoundedCache("tickets", TICKETS_CACHE_MAX, TICKETS_CACHE_TTL_S)
+
+    def get(self, ticket_id: str) -> Optional[Ticket]:
+        t = self._cache.get(ticket_id)
+        if t is None:
+            t = db_load_ticket(ticket_id)
+            if t is not None:
+                self._cache[ticket_id] = t
+        return t
+
+    def put(self, t: Ticket) -> None:
+        self._cache[t.id] = t
+
+    async def save(self, t: Ticket) -> None:
+        self.put(t)
+        await save_ticket_snapshot(t)
+
+    def discard(self, ticket_id: str) -> None:
+        """Закрытые/отклонённые заявки сразу убираем из памяти (в БД они остаются)."""
+        self._cache.pop(ticket_id, None)
+
+    def warm_up(self) -> int:
+        loaded = db_load_open_tickets()
+        for t in loaded[: self._cache.max_items]:
+            if t.id not in self._cache:
+                self._cache[t.id] = t
+        return len(loaded)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+class PendingReplyStore:
+    """Ожидаемые реплаи на сообщения бота, ключ — (chat_id, message_id):
+    комментарий к отклонению, вопрос на уточнение, комментарий руководителя
+    и ответ автора на уточнение (ctx["type"]).
+
+    Память (BoundedCache) + таблица pending_replies с истечением, поэтому
+    после рестарта ответ пользователя не теряется: get() — один поиск по PK.
+
+    Вторичный индекс (type, ticket_id, executor_id) -> key держится в
+    согласии с памятью на put/pop/вытеснении; промах добирается из БД
+    по idx_pending_ticket.
+    """
+
+    def __init__(self, max_items: int, default_ttl_s: float):
+        self._mem = BoundedCache("reply_wait", max_items, on_evict=self._on_evict)
+        self._by_owner: Dict[Tuple[str, str, Optional[int]], Tuple[int, int]] = {}
+        self.default_ttl_s = default_ttl_s
+
+    @staticmethod
+    def _owner(ctx: Dict[str, Any]) -> Tuple[str, str, Optional[int]]:
+        return ctx["type"], ctx["ticket_id"], ctx.get("executor_id")
+
+    def _index(self, key: Tuple[int, int], ctx: Dict[str, Any]) -> None:
+        self._by_owner[self._owner(ctx)] = key
+
+    def _unindex(self, key: Tuple[int, int], ctx: Dict[str, Any]) -> None:
+        owner = self._owner(ctx)
+        if self._by_owner.get(owner) == key:
+            del self._by_owner[owner]
+
+    def _on_evict(self, key: Tuple[int, int], item: Tuple[float, Dict[str, Any]]) -> None:
+        self._unindex(key, item[1])
+
+    def _forget(self, key: Tuple[int, int]) -> None:
+        item = self._mem.pop(key)
+        if item is not None:
+            self._unindex(key, item[1])
+
+    def get(self, key: Tuple[int, int]) -> Optional[Dict[str, Any]]:
+        item = self._mem.get(key)
+        if item is None:
+            item = db_get_pending_reply(key)
+            if item is None:
+                return None
+            self._mem[key] = item
+            self._index(key, item[1])
+        expires, ctx = item
+        if time.time() >= expires:
+            self._forget(key)
+            self._mem.expired += 1
+            return None
+        return ctx
+
+    def find(self, kind: str, ticket_id: str, executor_id: Optional[int]) -> Optional[Tuple[int, int]]:
+        """Ключ ожидания данного исполнителя по заявке или None."""
+        key = self._by_owner.get((kind, ticket_id, executor_id))
+        if key is None:
+            key = db_find_pending_reply(kind, ticket_id, executor_id)
+        if key is None or self.get(key) is None:
+            return None
+        return key
+
+    async def put(self, key: Tuple[int, int], ctx: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        expires = time.time() + (ttl_s or self.default_ttl_s)
+        self._forget(key)
+        self._mem[key] = (expires, ctx)
+        self._index(key, ctx)
+        # ctx сериализуем здесь: хендлеры продолжают менять его, пока команда в очереди
+        await db_write(_pending_reply_upsert, _pending_reply_row(key, ctx, expires))
+
+    async def pop(self, key: Tuple[int, int]) -> None:
+        self._forget(key)
+        await db_write(_pending_reply_delete, key)
+
+    def items(self) -> List[Tuple[Tuple[int, int], Dict[str, Any]]]:
+        now = time.time()
+        return [(k, ctx) for k, (expires, ctx) in self._mem.items() if expires > now]
+
+    def stats(self) -> Dict[str, Any]:
+        return self._mem.stats()
+
+REPLY_WAIT = PendingReplyStore(REPLY_WAIT_MAX, REPLY_WAIT_TTL_S)
+TICKETS = TicketRepository()
+CLASSIFY_CACHE = BoundedCache("classify", CLASSIFY_CACHE_MAX)   # ключ см. classify()
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        "tickets": TICKETS.stats(),
+        "reply_wait": REPLY_WAIT.stats(),
+        "classify": {**CLASSIFY_CACHE.stats(), "rules": MATCHER.version},
+    }
 
 # ============================================
 # ОТПРАВКА В ГРУППУ / РУКОВОДИТЕЛЮ (с фолбэком)
 # ============================================
 
-async def send_to_group(bot, t: Dict[str, Any]) -> Optional[Message]:
-    group = t["classification"]["group"]
+async def send_to_group(bot, t: Ticket) -> Optional[Message]:
+    group = t.group
     chat_id = get_group_chat_id(group)
     if not chat_id:
         return None
-    kb = kb_after_accept(t["id"]) if t.get("status") == "accepted" else kb_initial(t["id"])
+    kb = kb_after_accept(t.id) if t.status == "accepted" else kb_initial(t.id)
     try:
         msg = await bot.send_message(chat_id=chat_id, text=ticket_group_text(t), reply_markup=kb, parse_mode="HTML")
         return msg
@@ -772,7 +2519,7 @@ async def send_to_leaders(bot, group: str, text: str, kb: InlineKeyboardMarkup)
     failed: list[int] = []
 
     # 1) По ролям в БД
-    db_leaders = db_find_users_by_role_prefix(f"leader:{group}") or []
+    db_leaders = db_find_users_by_role("leader", group) or []
     db_leader_ids = [r["telegram_user_id"] for r in db_leaders]
     if db_leader_ids:
         for leader_id in db_leader_ids:
@@ -818,13 +2565,13 @@ async def send_to_leaders(bot, group: str, text: str, kb: InlineKeyboardMarkup)
 
     return delivered, failed
 
-async def post_leader_card_to_group(bot, t: Dict[str, Any], leader_text: str, reason_code: str) -> None:
+async def post_leader_card_to_group(bot, t: Ticket, leader_text: str, reason_code: str) -> None:
     """ФОЛБЭК: если лидерам в личку не доставилось — постим карточку в групповой чат (реплаем к заявке)."""
     try:
-        kb = kb_leader_choose_group(t["id"]) if reason_code == "other_group" else kb_leader_approve_or_cancel(t["id"])
+        kb = kb_leader_choose_group(t.id) if reason_code == "other_group" else kb_leader_approve_or_cancel(t.id)
         await bot.send_message(
-            chat_id=t["group_chat_id"],
-            reply_to_message_id=t["group_message_id"],
+            chat_id=t.group_chat_id,
+            reply_to_message_id=t.group_message_id,
             text=leader_text + "\n\n(Сообщение опубликовано здесь, т.к. не удалось доставить в личку лидеру.)",
             reply_markup=kb,
             parse_mode="HTML",
@@ -874,6 +2621,9 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/echo_chat_id_any — chat_id текущего чата (диагностика)\n"
         "/echo_chat_id — то же, но только для админов\n"
         "/debug_env — показать chat_id групп и аудит-канала (админ)\n"
+        "/open_tickets — открытые заявки по группам (админ)\n"
+        "/cache_stats — статистика кэшей в памяти (админ)\n"
+        "/ticket_history <id> — история заявки по событиям (админ)\n"
         "/export_excel — выгрузить Excel\n"
         "/export_csv — выгрузить CSV\n\n"
         "Важно: когда бот просит комментарий — отвечайте РЕПЛАЕМ на сообщение бота."
@@ -910,6 +2660,44 @@ async def debug_env(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"AUDIT_CHAT_ID={get_audit_chat_id()}"
     )
 
+@admin_only
+async def open_tickets_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    counts = db_count_open_tickets_by_group()
+    lines = [f"{g}: {n}" for g, n in sorted(counts.items())] or ["нет"]
+    await update.message.reply_text(
+        "Открытые заявки по группам:\n" + "\n".join(lines) +
+        f"\n\nВ работе у вас: {db_count_executor_open(update.effective_user.id)}"
+    )
+
+@admin_only
+async def cache_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = []
+    for name, st in cache_stats().items():
+        lines.append(
+            f"{name}: {st['size']}/{st['max']} | hit {st['hits']} / miss {st['misses']} ({st['hit_rate']:.0%}) | "
+            f"evicted {st['evictions']} | expired {st['expired']}"
+            + (f" | rules {st['rules']}" if "rules" in st else "")
+        )
+    await update.message.reply_text("\n".join(lines))
+
+@admin_only
+async def ticket_history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    t_id = (context.args or [""])[0].lstrip("#")
+    events = db_load_ticket_events(t_id) if t_id else []
+    if not events:
+        await update.message.reply_text("Использование: /ticket_history <id> (событий не найдено)")
+        return
+    view = ticket_view_from_events(events)
+    lines = [f"#{t_id}: {view.get('status') or '—'} | {view.get('group') or '—'} / {view.get('category') or '—'}"]
+    for col in ("created_ts", "queued_ts", "accepted_ts", "rejected_ts", "rerouted_ts", "closed_ts"):
+        if view.get(col):
+            lines.append(f"{col}: {view[col]}")
+    if view.get("executor_name") or view.get("executor_id"):
+        lines.append(f"Исполнитель: {view.get('executor_name') or view.get('executor_id')}")
+    lines.append("")
+    lines.extend(f"{ev.get('ts', '—')} {ev['event']}" for ev in events[-20:])
+    await update.message.reply_text("\n".join(lines))
+
 async def verify_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Нажмите кнопку ниже, чтобы отправить боту ваш номер телефона:", reply_markup=verify_reply_kb())
 
@@ -940,6 +2728,9 @@ def build_role_aware_commands(roles: Set[str]) -> List[BotCommand]:
             [
                 BotCommand("echo_chat_id", "Показать chat_id (админ)"),
                 BotCommand("debug_env", "Показать chat_id групп/аудита (админ)"),
+                BotCommand("open_tickets", "Открытые заявки по группам (админ)"),
+                BotCommand("cache_stats", "Статистика кэшей (админ)"),
+                BotCommand("ticket_history", "История заявки по событиям (админ)"),
             ]
         )
     return cmds
@@ -981,7 +2772,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not roles:
         await update.message.reply_text(f"Номер {phone} не найден в списке доступа. Обратитесь к администратору.")
         return
-    db_upsert_user(u.id, phone, u.full_name or "", roles_csv(roles))
+    await db_upsert_user(u.id, phone, u.full_name or "", roles_csv(roles))
     await update.message.reply_text(
         f"Готово! Номер подтверждён: {phone}\n"
         f"Ваши роли: {db_roles_ru(u.id)}",
@@ -1009,29 +2800,23 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ch = update.effective_chat
 
     try:
-        result = classify(text)
-        group = result.get("group", "Неопределено")
-        category = result.get("category", "Другое")
-
         t_id = uuid.uuid4().hex[:8].upper()
-        ticket = {
-            "id": t_id,
-            "submitter_id": u.id if u else None,
-            "submitter_name": (u.full_name if u else None),
-            "submitter_chat_id": ch.id if ch else None,
-            "text": text,
-            "classification": result,
-            "status": "created",
-            "created_ts": iso_now(),
-            "initial_group": None,
-        }
+        ticket = Ticket(
+            id=t_id,
+            submitter_id=u.id if u else None,
+            submitter_name=(u.full_name if u else None),
+            submitter_chat_id=ch.id if ch else None,
+            text=text,
+            created_ts=iso_now(),
+        )
+        # normalize_text — один раз на сообщение: ticket.normalized кэширует результат
+        result = classify(text, ticket.normalized)
+        ticket.set_group(result.get("group", "Неопределено"))
+        ticket.category = _intern(result.get("category", "Другое"))
         context.user_data["last_ticket"] = ticket
 
-        event = {"event": "new_text", **ticket}
-        save_ticket_event_jsonl(event)
-        db_insert_event(event)
-        db_upsert_ticket_snapshot(ticket)
-        db_touch_ticket_timestamp(t_id, "created_ts")
+        event = ticket.snapshot_event("new_text", hits=top_hits(result.get("hits") or {}))
+        await record_ticket_transition(ticket, event, "created_ts")
 
         kb = InlineKeyboardMarkup(
             [
@@ -1041,15 +2826,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         msg = (
             "Предварительная классификация (УТО):\n"
-            f"• Группа-исполнитель: <b>{group}</b>\n"
-            f"• Категория: <b>{category}</b>\n"
+            f"• Группа-исполнитель: <b>{ticket.group}</b>\n"
+            f"• Категория: <b>{ticket.category}</b>\n"
             f"• Номер заявки: <b>#{t_id}</b>\n\n"
             "Если всё верно — подтвердите отправку в группу."
         )
         await update.message.reply_html(msg, reply_markup=kb)
 
-        await audit_log(context.bot, f"📝 <b>Draft ticket</b> #{t_id} from {user_link_html(ticket['submitter_id'], ticket['submitter_name'])}\n"
-                                     f"Group: {group} / Category: {category}")
+        await audit_log(context.bot, f"📝 <b>Draft ticket</b> #{t_id} from {user_link_html(ticket.submitter_id, ticket.submitter_name)}\n"
+                                     f"Group: {ticket.group} / Category: {ticket.category}")
 
     except Exception:
         logger.exception("handle_text failed")
@@ -1223,31 +3008,28 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("Не найден контекст заявки, отправьте текст ещё раз.")
                 return
 
-            if not ticket.get("initial_group"):
-                ticket["initial_group"] = ticket["classification"]["group"]
+            if not ticket.initial_group:
+                ticket.initial_group = ticket.group
 
-            ticket["status"] = "queued"
-            TICKETS[ticket["id"]] = ticket
+            ticket.status = "queued"
+            TICKETS.put(ticket)
 
-            event = {"event": "queued_to_group", **ticket}
-            save_ticket_event_jsonl(event)
-            db_insert_event(event)
-            db_upsert_ticket_snapshot(ticket)
-            db_touch_ticket_timestamp(ticket["id"], "queued_ts")
+            event = ticket.event("queued_to_group", initial_group=ticket.initial_group)
+            await record_ticket_transition(ticket, event, "queued_ts")
 
             msg = await send_to_group(context.bot, ticket)
             if msg:
-                ticket["group_chat_id"] = msg.chat.id
-                ticket["group_message_id"] = msg.message_id
-                db_upsert_ticket_snapshot(ticket)
+                ticket.group_chat_id = msg.chat.id
+                ticket.group_message_id = msg.message_id
+                await TICKETS.save(ticket)
                 await query.answer("Заявка отправлена в группу.")
                 await query.edit_message_reply_markup(reply_markup=None)
-                await audit_log(context.bot, f"📤 Sent to group #{ticket['id']} → {ticket['classification']['group']} / {ticket['classification']['category']}")
+                await audit_log(context.bot, f"📤 Sent to group #{ticket.id} → {ticket.group} / {ticket.category}")
             else:
                 await query.answer("Не удалось отправить в чат группы. Проверьте настройки.")
                 try:
                     await context.bot.send_message(
-                        chat_id=ticket["submitter_chat_id"],
+                        chat_id=ticket.submitter_chat_id,
                         text="Не удалось отправить вашу заявку в чат группы. Обратитесь к администратору."
                     )
                 except Exception:
@@ -1275,29 +3057,25 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not t:
                 await query.answer("Заявка не найдена (возможно, бот перезапускался).")
                 return
-            group = t["classification"]["group"]
+            group = t.group
             if not has_group_power(user.id, group):
                 await query.answer("Недостаточно прав для действий по этой заявке.", show_alert=True)
                 return
             # Раньше проверяли message_id и считали «устаревшим». Теперь достаточно совпадения чата.
-            if query.message and (t.get("group_chat_id") != query.message.chat.id):
+            if query.message and (t.group_chat_id != query.message.chat.id):
                 await query.answer("Это сообщение не из чата группы этой заявки.")
                 return
 
         if action == "accept":
-            if t["status"] in {"accepted", "closed"}:
+            if t.status in {"accepted", "closed"}:
                 await query.answer("Уже в работе/закрыта.")
                 return
-            t["status"] = "accepted"
-            t["executor_id"] = user.id
-            t["executor_name"] = user.full_name
-            TICKETS[t_id] = t
+            t.status = "accepted"
+            t.executor_id = user.id
+            t.executor_name = user.full_name
+            TICKETS.put(t)
 
-            save_ticket_event_jsonl({"event": "accepted", "ticket_id": t_id, "executor_id": user.id})
-            db_insert_event({"event": "accepted", "ticket_id": t_id, "executor_id": user.id,
-                             "group": group, "category": t["classification"]["category"]})
-            db_upsert_ticket_snapshot(t)
-            db_touch_ticket_timestamp(t_id, "accepted_ts")
+            await record_ticket_transition(t, t.event("accepted", executor_id=user.id, executor_name=user.full_name), "accepted_ts")
 
             try:
                 await query.edit_message_text(text=ticket_group_text(t), reply_markup=kb_after_accept(t_id), parse_mode="HTML")
@@ -1306,7 +3084,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             try:
                 await context.bot.send_message(
-                    chat_id=t["submitter_chat_id"],
+                    chat_id=t.submitter_chat_id,
                     text=(f"Заявка #{t_id} принята в работу.\nИсполнитель: {user_link_html(user.id, user.full_name)}"),
                     parse_mode="HTML",
                 )
@@ -1323,12 +3101,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Выберите причину отклонения ниже, затем напишите комментарий РЕПЛАЕМ на это сообщение.",
                 reply_markup=kb_reject_reasons(t_id)
             )
-            REPLY_WAIT[(prompt.chat.id, prompt.message_id)] = {
+            await REPLY_WAIT.put((prompt.chat.id, prompt.message_id), {
                 "type": "reject_comment_wait",
                 "ticket_id": t_id,
                 "executor_id": user.id,
                 "reason_code": None,
-            }
+            })
             return
 
         if action == "rejchoose":
@@ -1336,21 +3114,20 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if reason_code not in {"not_uto","other_group","no_access"}:
                 await query.answer("Неизвестная причина.")
                 return
-            found_key = None
-            for k, v in list(REPLY_WAIT.items()):
-                if v.get("type") == "reject_comment_wait" and v.get("ticket_id") == t_id and v.get("executor_id") == user.id:
-                    found_key = k
+            found_key = REPLY_WAIT.find("reject_comment_wait", t_id, user.id)
             if found_key is None:
                 prompt = await query.message.reply_text("Напишите комментарий РЕПЛАЕМ на это сообщение (почему отклоняете).")
                 found_key = (prompt.chat.id, prompt.message_id)
-                REPLY_WAIT[found_key] = {
+                await REPLY_WAIT.put(found_key, {
                     "type": "reject_comment_wait",
                     "ticket_id": t_id,
                     "executor_id": user.id,
                     "reason_code": reason_code,
-                }
+                })
             else:
-                REPLY_WAIT[found_key]["reason_code"] = reason_code
+                ctx = REPLY_WAIT.get(found_key)
+                ctx["reason_code"] = reason_code
+                await REPLY_WAIT.put(found_key, ctx)
 
             await query.answer("Причина зафиксирована. Введите комментарий РЕПЛАЕМ.")
             return
@@ -1358,32 +3135,27 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if action == "clarify":
             await query.answer()
             prompt = await query.message.reply_text("Введите уточняющий вопрос РЕПЛАЕМ на это сообщение — мы отправим его автору.")
-            REPLY_WAIT[(prompt.chat.id, prompt.message_id)] = {
+            await REPLY_WAIT.put((prompt.chat.id, prompt.message_id), {
                 "type": "clarify_question",
                 "ticket_id": t_id,
                 "executor_id": user.id,
-            }
+            })
             return
 
         if action == "complete":
-            if t["status"] != "accepted":
+            if t.status != "accepted":
                 await query.answer("Сначала возьмите заявку в работу.")
                 return
             roles = db_get_user_roles(user.id)
-            if (t.get("executor_id") not in (None, user.id)) and (f"leader:{t['classification']['group']}" not in roles) and ("admin" not in roles):
+            if (t.executor_id not in (None, user.id)) and (f"leader:{t.group}" not in roles) and ("admin" not in roles):
                 await query.answer("Завершить может только принявший исполнитель (или руководитель/админ).")
                 return
 
-            t["status"] = "closed"
-            t["closed"] = True
-            t["completed_by"] = user.id
-            TICKETS[t_id] = t
+            t.status = "closed"
+            t.completed_by = user.id
 
-            save_ticket_event_jsonl({"event": "closed_by_executor", "ticket_id": t_id, "executor_id": user.id})
-            db_insert_event({"event": "closed_by_executor", "ticket_id": t_id, "executor_id": user.id,
-                             "group": t["classification"]["group"], "category": t["classification"]["category"]})
-            db_upsert_ticket_snapshot(t)
-            db_touch_ticket_timestamp(t_id, "closed_ts")
+            await record_ticket_transition(t, t.event("closed_by_executor", executor_id=user.id), "closed_ts")
+            TICKETS.discard(t_id)
 
             try:
                 await query.edit_message_text(text=ticket_group_text(t), reply_markup=None, parse_mode="HTML")
@@ -1392,7 +3164,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             try:
                 await context.bot.send_message(
-                    chat_id=t["submitter_chat_id"],
+                    chat_id=t.submitter_chat_id,
                     text=(f"Исполнитель {user_link_html(user.id, user.full_name)} закрыл заявку #{t_id}. ✅"),
                     parse_mode="HTML",
                 )
@@ -1408,37 +3180,36 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not t:
                 await query.answer("Заявка не найдена.")
                 return
-            group = t["classification"]["group"]
+            group = t.group
             roles = db_get_user_roles(user.id)
             if not (f"leader:{group}" in roles or "dispatcher" in roles or "admin" in roles):
                 await query.answer("Только для руководителя соответствующей группы (или диспетчера/админа).", show_alert=True)
                 return
 
             if action == "leadapprove":
-                pend = t.get("pending_reject")
+                pend = t.pending_reject
                 if not pend or pend.get("reason_code") == "other_group":
                     await query.answer("Нет ожидающего отклонения (или выбрана маршрутизация).")
                     return
-                t["status"] = "rejected"
-                t["reject_reason_code"] = pend["reason_code"]
-                t["reject_comment"] = pend.get("comment")
-                t["leader_id"] = user.id
-                t["leader_name"] = user.full_name
-                t["leader_decision_ts"] = iso_now()
-                t["rejected_ts"] = t.get("rejected_ts") or iso_now()
-                t.pop("pending_reject", None)
-                TICKETS[t_id] = t
-
-                save_ticket_event_jsonl({"event": "rejected", "ticket_id": t_id, "executor_id": pend["executor_id"], "leader_id": user.id, "comment": t["reject_comment"]})
-                db_insert_event({"event": "rejected", "ticket_id": t_id, "executor_id": pend["executor_id"], "leader_id": user.id,
-                                 "group": group, "category": t["classification"]["category"], "comment": t["reject_comment"]})
-                db_upsert_ticket_snapshot(t)
-                db_touch_ticket_timestamp(t_id, "rejected_ts")
+                t.status = "rejected"
+                t.reject_reason_code = pend["reason_code"]
+                t.reject_comment = pend.get("comment")
+                t.leader_id = user.id
+                t.leader_name = user.full_name
+                t.leader_decision_ts = iso_now()
+                t.rejected_ts = t.rejected_ts or iso_now()
+                t.pending_reject = None
+
+                await record_ticket_transition(t, t.event("rejected", executor_id=pend["executor_id"], leader_id=user.id,
+                                                          leader_name=user.full_name, reject_reason_code=t.reject_reason_code,
+                                                          reject_comment=t.reject_comment),
+                                               "rejected_ts")
+                TICKETS.discard(t_id)
 
                 try:
                     await context.bot.edit_message_text(
-                        chat_id=t["group_chat_id"],
-                        message_id=t["group_message_id"],
+                        chat_id=t.group_chat_id,
+                        message_id=t.group_message_id,
                         text=ticket_group_text(t),
                         parse_mode="HTML",
                         reply_markup=None,
@@ -1448,16 +3219,16 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 try:
                     await context.bot.send_message(
-                        chat_id=t["submitter_chat_id"],
+                        chat_id=t.submitter_chat_id,
                         text=(f"Заявка #{t_id} отклонена.\n"
-                              f"Причина: { {'not_uto':'Не к УТО','no_access':'Нет доступа к помещению'}.get(t['reject_reason_code'],'—') }\n"
-                              f"Комментарий: {html_escape(t.get('reject_comment') or '-', False)}"),
+                              f"Причина: { {'not_uto':'Не к УТО','no_access':'Нет доступа к помещению'}.get(t.reject_reason_code,'—') }\n"
+                              f"Комментарий: {html_escape(t.reject_comment or '-', False)}"),
                         parse_mode="HTML",
                     )
                 except Exception:
                     logger.exception("notify submitter rejected failed")
 
-                await audit_log(context.bot, f"❌ Rejected (leader approved) #{t_id} reason={t['reject_reason_code']}")
+                await audit_log(context.bot, f"❌ Rejected (leader approved) #{t_id} reason={t.reject_reason_code}")
                 await query.answer("Отклонение согласовано.")
                 return
 
@@ -1467,11 +3238,11 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     chat_id=user.id,
                     text="Отмена отклонения: ответьте РЕПЛАЕМ на это сообщение и укажите комментарий исполнителю (можно пусто)."
                 )
-                REPLY_WAIT[(prompt.chat.id, prompt.message_id)] = {
+                await REPLY_WAIT.put((prompt.chat.id, prompt.message_id), {
                     "type": "leader_cancel_comment",
                     "ticket_id": t_id,
                     "leader_id": user.id,
-                }
+                })
                 return
 
             if action == "leadroute":
@@ -1479,36 +3250,34 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if dest_group not in {"СВС","СГЭ","ССТ"}:
                     await query.answer("Неизвестная группа.")
                     return
-                pend = t.get("pending_reject")
+                pend = t.pending_reject
                 if not pend or pend.get("reason_code") != "other_group":
                     await query.answer("Маршрутизация не ожидается.")
                     return
 
-                t["classification"]["group"] = dest_group
-                t["status"] = "queued"
-                t["rerouted_to_group"] = dest_group
-                t["rerouted_ts"] = iso_now()
-                if not t.get("initial_group"):
-                    t["initial_group"] = pend.get("from_group") or group
-                t["executor_id"] = None
-                t["executor_name"] = None
-                t.pop("pending_reject", None)
-                TICKETS[t_id] = t
+                t.set_group(dest_group)
+                t.status = "queued"
+                t.rerouted_to_group = dest_group
+                t.rerouted_ts = iso_now()
+                if not t.initial_group:
+                    t.initial_group = _intern(pend.get("from_group") or group)
+                t.executor_id = None
+                t.executor_name = None
+                t.pending_reject = None
+                TICKETS.put(t)
 
                 msg = await send_to_group(context.bot, t)
                 if msg:
-                    t["group_chat_id"] = msg.chat.id
-                    t["group_message_id"] = msg.message_id
+                    t.group_chat_id = msg.chat.id
+                    t.group_message_id = msg.message_id
 
-                db_upsert_ticket_snapshot(t)
-                db_touch_ticket_timestamp(t_id, "queued_ts")
-                save_ticket_event_jsonl({"event": "rerouted", "ticket_id": t_id, "leader_id": user.id, "to_group": dest_group})
-                db_insert_event({"event": "rerouted", "ticket_id": t_id, "executor_id": pend["executor_id"], "leader_id": user.id,
-                                 "group": dest_group, "category": t["classification"]["category"], "to_group": dest_group})
+                await record_ticket_transition(t, t.event("rerouted", rejected_by=pend["executor_id"], leader_id=user.id,
+                                                          leader_name=user.full_name, rerouted_to_group=dest_group),
+                                               "queued_ts")
 
                 try:
                     await context.bot.send_message(
-                        chat_id=t["submitter_chat_id"],
+                        chat_id=t.submitter_chat_id,
                         text=(f"Ваша заявка #{t_id} перенаправлена в группу {dest_group}."),
                     )
                 except Exception:
@@ -1544,31 +3313,30 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         t_id = ctx["ticket_id"]
         t = TICKETS.get(t_id)
         if not t:
-            REPLY_WAIT.pop(reply_key, None)
+            await REPLY_WAIT.pop(reply_key)
             return
         reason = ctx.get("reason_code")
         if reason not in {"not_uto","other_group","no_access"}:
             await update.message.reply_text("Сначала выберите причину отклонения кнопкой, затем повторите комментарий РЕПЛАЕМ.")
             return
 
-        t["pending_reject"] = {
+        t.pending_reject = {
             "executor_id": u.id,
             "executor_name": u.full_name,
-            "from_group": t["classification"]["group"],
+            "from_group": t.group,
             "reason_code": reason,
             "comment": text,
             "ts": iso_now(),
         }
-        t["reject_reason_code"] = reason
-        t["reject_comment"] = text
-        TICKETS[t_id] = t
-        db_upsert_ticket_snapshot(t)
+        t.reject_reason_code = reason
+        t.reject_comment = text
+        await TICKETS.save(t)
 
         # Обновим карточку без кнопок (ожидание решения руководителя)
         try:
             await context.bot.edit_message_text(
-                chat_id=t["group_chat_id"],
-                message_id=t["group_message_id"],
+                chat_id=t.group_chat_id,
+                message_id=t.group_message_id,
                 text=ticket_group_text(t),
                 parse_mode="HTML",
                 reply_markup=None,
@@ -1579,7 +3347,7 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Текст руководителю
         leader_text = (
             f"⛔ Запрос на отклонение заявки #{t_id}\n"
-            f"Группа: {t['classification']['group']} / Категория: {t['classification']['category']}\n"
+            f"Группа: {t.group} / Категория: {t.category}\n"
             f"Исполнитель: {user_link_html(u.id, u.full_name)}\n"
             f"Причина: { {'not_uto':'Не к УТО','other_group':'К другой группе','no_access':'Нет доступа к помещению'}[reason] }\n"
             f"Комментарий: {html_escape(text, False)}\n\n"
@@ -1588,7 +3356,7 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         kb = kb_leader_choose_group(t_id) if reason == "other_group" else kb_leader_approve_or_cancel(t_id)
 
         # Пытаемся отправить руководителям в личку (БД → ENV)
-        delivered, failed = await send_to_leaders(context.bot, t["classification"]["group"], leader_text, kb)
+        delivered, failed = await send_to_leaders(context.bot, t.group, leader_text, kb)
 
         # Если никому не доставили — фолбэк: публикуем карточку на согласование в ГРУППОВОЙ ЧАТ
         if not delivered:
@@ -1600,7 +3368,7 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Отклонение отправлено руководителю на согласование в личные сообщения.")
 
         await audit_log(context.bot, f"⏳ Reject pending #{t_id} reason={reason} → leaders delivered: {delivered}; failed: {failed}")
-        REPLY_WAIT.pop(reply_key, None)
+        await REPLY_WAIT.pop(reply_key)
         return
 
     # 2) Вопрос на уточнение от исполнителя
@@ -1608,19 +3376,18 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         t_id = ctx["ticket_id"]
         t = TICKETS.get(t_id)
         if not t:
-            REPLY_WAIT.pop(reply_key, None)
+            await REPLY_WAIT.pop(reply_key)
             return
 
-        t["status"] = "clarifying"
-        t["clarify_question"] = text
-        t["clarify_requested_ts"] = iso_now()
-        TICKETS[t_id] = t
-        db_upsert_ticket_snapshot(t)
+        t.status = "clarifying"
+        t.clarify_question = text
+        t.clarify_requested_ts = iso_now()
+        await TICKETS.save(t)
 
         try:
             await context.bot.edit_message_text(
-                chat_id=t["group_chat_id"],
-                message_id=t["group_message_id"],
+                chat_id=t.group_chat_id,
+                message_id=t.group_message_id,
                 text=ticket_group_text(t),
                 parse_mode="HTML",
                 reply_markup=None,
@@ -1630,38 +3397,39 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         try:
             msg = await context.bot.send_message(
-                chat_id=t["submitter_chat_id"],
+                chat_id=t.submitter_chat_id,
                 text=(f"По заявке #{t_id} требуется уточнение от исполнителя "
                       f"{user_link_html(ctx['executor_id'], u.full_name)}:\n\n"
                       f"{html_escape(text, False)}\n\n"
                       f"Пожалуйста, ответьте <b>реплаем на это сообщение</b>."),
                 parse_mode="HTML",
             )
-            CLARIFY_AUTHOR_WAIT[(t["submitter_chat_id"], msg.message_id)] = {
+            await REPLY_WAIT.put((t.submitter_chat_id, msg.message_id), {
+                "type": "clarify_answer_wait",
                 "ticket_id": t_id,
                 "executor_id": ctx["executor_id"],
-            }
+            }, ttl_s=CLARIFY_WAIT_TTL_S)
         except Exception:
             logger.exception("send clarify to author failed")
 
         await update.message.reply_text("Вопрос отправлен автору. Ожидаем ответа.")
         await audit_log(context.bot, f"🔎 Clarify requested #{t_id}")
-        REPLY_WAIT.pop(reply_key, None)
+        await REPLY_WAIT.pop(reply_key)
         return
 
     # 3) Комментарий руководителя при отмене отклонения
     if ctx and ctx.get("type") == "leader_cancel_comment":
         t_id = ctx["ticket_id"]
         t = TICKETS.get(t_id)
-        REPLY_WAIT.pop(reply_key, None)
+        await REPLY_WAIT.pop(reply_key)
         if not t:
             return
 
         leader_comment = text or ""
 
         # Исполнитель, который инициировал отклонение (или текущий)
-        pend_exec = (t.get("pending_reject") or {}).get("executor_id") or t.get("executor_id")
-        pend_exec_name = (t.get("pending_reject") or {}).get("executor_name") or t.get("executor_name")
+        pend_exec = (t.pending_reject or {}).get("executor_id") or t.executor_id
+        pend_exec_name = (t.pending_reject or {}).get("executor_name") or t.executor_name
 
         if pend_exec:
             try:
@@ -1677,28 +3445,27 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Публикуем комментарий руководителя в ГРУППОВОЙ ЧАТ (реплай) + КНОПКИ
         try:
             msg2 = await context.bot.send_message(
-                chat_id=t["group_chat_id"],
-                reply_to_message_id=t["group_message_id"],
+                chat_id=t.group_chat_id,
+                reply_to_message_id=t.group_message_id,
                 text=(f"↩️ Отмена отклонения по заявке #{t_id}.\n"
                       f"Руководитель: {user_link_html(u.id, u.full_name)}\n"
                       f"Комментарий: {html_escape(leader_comment or '-', False)}"),
                 parse_mode="HTML",
-                reply_markup=kb_after_accept(t_id) if t.get("executor_id") else kb_initial(t_id),
+                reply_markup=kb_after_accept(t_id) if t.executor_id else kb_initial(t_id),
             )
             # Делаем это сообщение актуальным для кнопок
-            t["group_message_id"] = msg2.message_id
-            TICKETS[t_id] = t
-            db_upsert_ticket_snapshot(t)
+            t.group_message_id = msg2.message_id
+            await TICKETS.save(t)
         except Exception:
             logger.exception("post leader cancel comment to group failed")
 
         # Обновить «шапку» карточки (не обязательно, но красиво)
         try:
-            kb = kb_after_accept(t_id) if t.get("executor_id") else kb_initial(t_id)
+            kb = kb_after_accept(t_id) if t.executor_id else kb_initial(t_id)
             await context.bot.edit_message_text(
-                chat_id=t["group_chat_id"],
-                message_id=t["group_message_id"],
-                text=ticket_group_text({**t, "pending_reject": None}),
+                chat_id=t.group_chat_id,
+                message_id=t.group_message_id,
+                text=ticket_group_text(replace(t, pending_reject=None)),
                 parse_mode="HTML",
                 reply_markup=kb,
             )
@@ -1707,44 +3474,40 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Закрепить за исполнителем и вернуть «в работе»
         if pend_exec:
-            t["executor_id"] = pend_exec
-            t["executor_name"] = pend_exec_name
-        t["status"] = "accepted"
-        if not t.get("accepted_ts"):
-            db_touch_ticket_timestamp(t_id, "accepted_ts")
-
-        t["leader_id"] = u.id
-        t["leader_name"] = u.full_name
-        t["leader_decision_ts"] = iso_now()
-        t.pop("pending_reject", None)
-        TICKETS[t_id] = t
-        db_upsert_ticket_snapshot(t)
+            t.executor_id = pend_exec
+            t.executor_name = pend_exec_name
+        t.status = "accepted"
+        t.leader_id = u.id
+        t.leader_name = u.full_name
+        t.leader_decision_ts = iso_now()
+        t.pending_reject = None
+        TICKETS.put(t)
+        await record_ticket_transition(t, None, None if t.accepted_ts else "accepted_ts")
 
         await audit_log(context.bot, f"↩️ Reject canceled by leader #{t_id}")
         return
 
     # 4) Ответ автора на уточнение — дублируем в группу (реплай) + КНОПКИ
-    info = CLARIFY_AUTHOR_WAIT.get(reply_key)
-    if info:
+    if ctx and ctx.get("type") == "clarify_answer_wait":
+        info = ctx
         t_id = info["ticket_id"]
         t = TICKETS.get(t_id)
-        CLARIFY_AUTHOR_WAIT.pop(reply_key, None)
+        await REPLY_WAIT.pop(reply_key)
         if not t:
             return
 
         answer = text
-        t["clarify_answer"] = answer
-        t["clarify_answered_ts"] = iso_now()
-        TICKETS[t_id] = t
-        db_upsert_ticket_snapshot(t)
+        t.clarify_answer = answer
+        t.clarify_answered_ts = iso_now()
+        await TICKETS.save(t)
 
         # Обновить карточку
         try:
-            kb = kb_after_accept(t_id) if (t.get("status") == "accepted" or t.get("executor_id")) else kb_initial(t_id)
+            kb = kb_after_accept(t_id) if (t.status == "accepted" or t.executor_id) else kb_initial(t_id)
             await context.bot.edit_message_text(
-                chat_id=t["group_chat_id"],
-                message_id=t["group_message_id"],
-                text=ticket_group_text({**t, "status": t.get("status") or "queued"}),
+                chat_id=t.group_chat_id,
+                message_id=t.group_message_id,
+                text=ticket_group_text(replace(t, status_code=t.status_code or _STATUS_CODE["queued"])),
                 parse_mode="HTML",
                 reply_markup=kb,
             )
@@ -1764,16 +3527,15 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Дублируем ответ автора в группу (реплай) + КНОПКИ
         try:
             msg2 = await context.bot.send_message(
-                chat_id=t["group_chat_id"],
-                reply_to_message_id=t["group_message_id"],
+                chat_id=t.group_chat_id,
+                reply_to_message_id=t.group_message_id,
                 text=(f"📩 Ответ автора по заявке #{t_id}:\n\n{html_escape(answer, False)}"),
                 parse_mode="HTML",
-                reply_markup=kb_after_accept(t_id) if (t.get("status") == "accepted" or t.get("executor_id")) else kb_initial(t_id),
+                reply_markup=kb_after_accept(t_id) if (t.status == "accepted" or t.executor_id) else kb_initial(t_id),
             )
             # Делаем это сообщение актуальным для кнопок
-            t["group_message_id"] = msg2.message_id
-            TICKETS[t_id] = t
-            db_upsert_ticket_snapshot(t)
+            t.group_message_id = msg2.message_id
+            await TICKETS.save(t)
         except Exception:
             logger.exception("post clarify answer to group failed")
 
@@ -1808,11 +3570,68 @@ async def _post_init(app):
     await set_default_commands(app.bot)
     logger.info("Default commands set via setMyCommands (scope=default).")
 
+async def _post_shutdown(app):
+    RULES_WATCHER.stop()
+    DB_WRITER.stop()
+    JSONL_EXPORTER.stop()  # после writer'а: дозаписывает уже закоммиченные события
+    DB.close_all()
+    close_jsonl_sinks()
+    logger.info("DB connections closed, JSONL flushed.")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m src.bot", description="Chat-bot УТО (Telegram)")
+    parser.add_argument("--full-reconcile", action="store_true",
+                        help="сверить снапшоты tickets со всей историей ticket_events (а не только с новыми событиями): "
+                             "исправить таймстемпы этапов и статус закрытых/отклонённых заявок")
+    parser.add_argument("--check-query-plans", action="store_true",
+                        help="проверить EXPLAIN QUERY PLAN отчётных запросов и выйти (код 1, если есть полный скан)")
+    parser.add_argument("--import-rules-docx", metavar="PATH", type=Path,
+                        help="собрать файл правил (RULES_FILE, по умолчанию data/rules.json) из таблицы "
+                             "КАТЕГОРИИ.docx и выйти; запущенный бот подхватит его сам")
+    parser.add_argument("--replay-jsonl", metavar="PATH", type=Path,
+                        help="импортировать события в SQLite и выйти: файл JSONL старых сборок (.jsonl/.jsonl.gz) "
+                             "или каталог сегментов (data/events); повторный запуск продолжает с checkpoint")
+    parser.add_argument("--since", metavar="ISO_TS",
+                        help="для --replay-jsonl: только события с ts >= ISO_TS (сегменты раньше не читаются)")
+    parser.add_argument("--until", metavar="ISO_TS",
+                        help="для --replay-jsonl: только события с ts <= ISO_TS")
+    return parser.parse_args(argv)
+
 def main():
+    args = parse_args()
     setup_logging(LOGS_DIR)
     load_env(PROJECT_ROOT)
+    if args.import_rules_docx:
+        groups = import_rules_docx(args.import_rules_docx)
+        write_rules_file(groups, rules_path())
+        logger.info(f"[RULES] {rules_path()}: {sum(len(c) for c in groups.values())} categories "
+                    f"from {args.import_rules_docx.name}")
+        raise SystemExit(0)
+    configure_jsonl_sinks()
+    RULES_WATCHER.start()
     db_init()
-    db_update_from_events()
+    if args.check_query_plans:
+        plan_problems = db_check_query_plans()
+        for p in plan_problems:
+            logger.warning(f"[DB PLAN] full scan: {p}")
+        logger.info("[DB PLAN] ok" if not plan_problems else f"[DB PLAN] {len(plan_problems)} problem(s)")
+        raise SystemExit(1 if plan_problems else 0)
+    if args.replay_jsonl:
+        replay_jsonl(args.replay_jsonl, since=args.since, until=args.until)
+        raise SystemExit(0)
+    db_update_from_events(full=args.full_reconcile)
+    purged = db_purge_expired_replies()
+    if purged:
+        logger.info(f"[REPLY WAIT] purged {purged} expired pending replies")
+    if os.getenv("TICKETS_WARMUP", "0").strip() == "1":
+        logger.info(f"[TICKETS] warm-up: {TICKETS.warm_up()} open tickets loaded")
+    DB_WRITER.start()
+    if os.getenv("JSONL_EXPORT", "1").strip() == "1":
+        try:
+            JSONL_EXPORTER.poll_ms = int(os.getenv("JSONL_EXPORT_POLL_MS", "500"))
+        except ValueError:
+            pass
+        JSONL_EXPORTER.start()
 
     global PHONE_ROLES_MAP
     PHONE_ROLES_MAP = load_phone_roles_from_env()
@@ -1832,6 +3651,7 @@ def main():
 
     # post_init — установим дефолтное меню команд
     app.post_init = _post_init
+    app.post_shutdown = _post_shutdown
 
     # Команды
     app.add_handler(CommandHandler("start", start))
@@ -1843,6 +3663,9 @@ def main():
     app.add_handler(CommandHandler("echo_chat_id_any", echo_chat_id_any))
     app.add_handler(CommandHandler("echo_chat_id", echo_chat_id))  # admin-only
     app.add_handler(CommandHandler("debug_env", debug_env))        # admin-only
+    app.add_handler(CommandHandler("open_tickets", open_tickets_cmd))  # admin-only
+    app.add_handler(CommandHandler("cache_stats", cache_stats_cmd))    # admin-only
+    app.add_handler(CommandHandler("ticket_history", ticket_history_cmd))  # admin-only
     app.add_handler(CommandHandler("export_excel", export_excel))
     app.add_handler(CommandHandler("export_csv", export_csv))
 
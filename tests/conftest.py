@@ -0,0 +1,13 @@
+import pytest
+
+from src import bot
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Пустая БД в tmp_path со схемой последней версии."""
+    monkeypatch.setattr(bot.DB, "path", tmp_path / "bot.db")
+    bot.db_init()
+    yield bot.DB
+    bot.DB_WRITER.stop()
+    bot.DB.close_all()
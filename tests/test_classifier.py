@@ -0,0 +1,58 @@
+import pytest
+
+from src import bot
+
+# Встроенный набор правил, а не файл правил: его может подменить RULES_FILE.
+MATCHER = bot.CategoryMatcher(bot.GROUP_CATEGORIES)
+
+# Короткие основы, совпадавшие внутри чужих слов, уводили эти тексты в
+# «Неприятный запах»/«Протечки»: (текст, категории без единого совпадения).
+MISROUTES = [
+    ("Запись на приём не работает", ("Неприятный запах",)),
+    ("запрос на пропуск", ("Неприятный запах",)),
+    ("заправить картридж", ("Неприятный запах",)),
+    ("запасной выход", ("Неприятный запах",)),
+    ("водитель не приехал", ("Протечки",)),
+    ("завод", ("Протечки",)),
+    ("заказать воду", ("Протечки",)),
+    ("проводка", ("Протечки",)),
+]
+
+# Формы слов, которые исходное совпадение подстрокой находило.
+ROUTES = [
+    ("теплом дует", "Настройка температуры / обдува"),
+    ("теплое помещение", "Настройка температуры / обдува"),
+    ("душное помещение", "Настройка температуры / обдува"),
+    ("жаркое помещение", "Ремонт вентиляции / кондиционера"),
+    ("запахом канализации тянет", "Неприятный запах"),
+    ("протекает вода с потолка", "Протечки"),
+    ("в туалете засор", "Засор"),
+    ("кондиционеp не работает", "Настройка температуры / обдува"),   # латинская p
+    ("проводка", "Провода"),
+]
+
+
+def _classify(text):
+    return bot._classify_norm(MATCHER, bot.normalize_text(text))
+
+
+@pytest.mark.parametrize("text,no_hits", MISROUTES)
+def test_short_stems_do_not_match_inside_words(text, no_hits):
+    res = _classify(text)
+    for group, title in MATCHER.categories:
+        if title in no_hits:
+            assert res["hits"][f"{group}:{title}"] == 0, title
+
+
+@pytest.mark.parametrize("text,category", ROUTES)
+def test_inflected_forms_route(text, category):
+    assert _classify(text)["category"] == category
+
+
+@pytest.mark.parametrize("ending", ["", "у", "ы", "е", "ом", "ое", "ая", "ые", "ой", "ую", "ого", "ыми", "ами"])
+def test_every_keyword_matches_its_forms(ending):
+    for group, cats in bot.GROUP_CATEGORIES.items():
+        for c in cats:
+            idx = MATCHER.categories.index((group, c["title"]))
+            for kw in c["kw"]:
+                assert MATCHER.count(bot.normalize_text(kw + ending))[idx], kw + ending
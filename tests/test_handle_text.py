@@ -0,0 +1,32 @@
+import asyncio
+from types import SimpleNamespace
+
+from src import bot
+
+
+def test_new_ticket_normalizes_text_once(db, monkeypatch):
+    bot.DB_WRITER.submit(bot._upsert_user, 5, "+70000000000", "Автор", "author").result()
+    calls = []
+    normalize = bot.normalize_text
+    monkeypatch.setattr(bot, "normalize_text", lambda text: calls.append(text) or normalize(text))
+    monkeypatch.setattr(bot, "audit_log", lambda *a, **k: asyncio.sleep(0))
+    monkeypatch.setattr(bot, "CLASSIFY_CACHE", bot.BoundedCache("classify", 10))
+    replies = []
+
+    async def reply_html(text, reply_markup=None):
+        replies.append(text)
+
+    update = SimpleNamespace(
+        message=SimpleNamespace(text="перегорела лампочка", reply_to_message=None, reply_html=reply_html),
+        effective_user=SimpleNamespace(id=5, full_name="Автор"),
+        effective_chat=SimpleNamespace(id=5),
+    )
+    context = SimpleNamespace(user_data={}, bot=None)
+    asyncio.run(bot.handle_text(update, context))
+
+    ticket = context.user_data["last_ticket"]
+    assert calls == ["перегорела лампочка"]
+    assert ticket.norm_text == normalize("перегорела лампочка")
+    assert (ticket.group, ticket.category) == ("СГЭ", "Замена освещения")
+    assert "Замена освещения" in replies[0]
+    assert bot.db_load_ticket(ticket.id).category == "Замена освещения"
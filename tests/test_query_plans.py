@@ -0,0 +1,11 @@
+from src import bot
+
+
+def test_report_queries_use_indexes(db):
+    assert bot.db_check_query_plans() == []
+
+
+def test_full_scan_is_reported(db, monkeypatch):
+    monkeypatch.setitem(bot.REPORT_QUERIES, "by_text", ("SELECT * FROM tickets WHERE text=?", ("x",)))
+    problems = bot.db_check_query_plans()
+    assert len(problems) == 1 and problems[0].startswith("by_text: SCAN tickets")
@@ -0,0 +1,50 @@
+import asyncio
+
+from src import bot
+
+
+def _accept_then_reroute(t):
+    """Переходы как в on_callback: accept, затем leadroute по отказу исполнителя."""
+    async def run():
+        await bot.record_ticket_transition(t, t.snapshot_event("new_text"), "created_ts")
+        t.status = "queued"
+        await bot.record_ticket_transition(t, t.event("queued_to_group"), "queued_ts")
+        t.status = "accepted"
+        t.executor_id, t.executor_name = 7, "Исполнитель"
+        await bot.record_ticket_transition(t, t.event("accepted", executor_id=7, executor_name="Исполнитель"),
+                                           "accepted_ts")
+        t.set_group("СГЭ")
+        t.status = "queued"
+        t.rerouted_to_group = "СГЭ"
+        t.rerouted_ts = bot.iso_now()
+        t.executor_id = t.executor_name = None
+        await bot.record_ticket_transition(t, t.event("rerouted", rejected_by=7, leader_id=1,
+                                                      rerouted_to_group="СГЭ"), "queued_ts")
+    asyncio.run(run())
+
+
+def test_view_matches_snapshot_after_reroute(db):
+    _accept_then_reroute(bot.Ticket(id="T1", submitter_id=3, text="нет света", group="СВС", status_code=1))
+    snap = bot.db_load_ticket("T1")
+    view = bot.ticket_view_from_events(bot.db_load_ticket_events("T1"))
+
+    assert snap.executor_id is None and snap.executor_name is None
+    assert view.get("executor_id") is None and view.get("executor_name") is None
+    assert view["rejected_by"] == 7
+    assert (view["status"], view["group"]) == (snap.status, snap.group) == ("queued", "СГЭ")
+    for col in ("created_ts", "accepted_ts", "rerouted_ts"):
+        assert view[col] == getattr(snap, col)
+
+
+def test_view_clears_executor_of_legacy_reroute_event():
+    events = [
+        {"event": "accepted", "ticket_id": "T2", "ts": "2025-01-01T10:00:00+00:00", "executor_id": 7,
+         "executor_name": "Исполнитель", "status": "accepted"},
+        {"event": "rerouted", "ticket_id": "T2", "ts": "2025-01-01T11:00:00+00:00", "executor_id": 7,
+         "status": "queued"},
+    ]
+    view = bot.ticket_view_from_events(events)
+    assert "executor_id" not in view and "executor_name" not in view
+    assert view["rejected_by"] == 7
+    assert view["accepted_ts"] == "2025-01-01T10:00:00+00:00"
+    assert view["rerouted_ts"] == "2025-01-01T11:00:00+00:00"